@@ -0,0 +1,4 @@
+# bench
+#
+# Benchmarks for the interpreter.  Lox workloads are in bench/workloads.
+# Run with python -m bench (see bench/harness.py).
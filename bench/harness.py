@@ -0,0 +1,168 @@
+# bench/harness.py
+#
+# Benchmark harness.  Runs each workload through the interpreter pipeline and
+# times the phases separately (using LoxContext.metrics):
+#
+#     lex        tokenizing the source
+#     parse      parsing (including the optimizer pass)
+#     resolve    resolution and specialization (LoxInterpreter.prepare)
+#     exec       running the program
+#
+# Every run uses a fresh LoxContext.  After some warmup runs, each workload is
+# run a number of times and the min and median time of each phase recorded.
+# Results can be saved as JSON and compared against a saved baseline:
+#
+#     python -m bench -o baseline.json
+#     ... change things ...
+#     python -m bench --baseline baseline.json
+#
+# The comparison uses the min time and reports a regression for any phase
+# that got more than --threshold slower.  Phases taking less than a
+# millisecond are too noisy to compare and are skipped.
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import loxcontext
+
+WORKLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workloads')
+
+PHASES = ('lex', 'parse', 'resolve', 'exec')
+
+# Smallest time (seconds) that's compared against a baseline
+NOISE_FLOOR = 0.001
+
+# A large program that mostly exercises the front end
+def generated_source(nfuncs=400):
+    lines = [ '// Generated' ]
+    for i in range(nfuncs):
+        lines.extend([
+            f'fun f{i}(a, b) {{',
+            f'  var x = a * {i} + b - (a / 2) * (b - {i});',
+            f'  if (x > {i} and !(a == b)) {{ x = x - 1; }} else {{ x = x + 1; }}',
+            f'  while (x > 100) x = x / 2;',
+            f'  return x;',
+            f'}}',
+            f'class C{i} {{',
+            f'  init() {{ this.value = {i}; }}',
+            f'  get(y) {{ return this.value + y; }}',
+            f'}}',
+            ])
+    lines.append('var total = 0;')
+    lines.extend(f'total = total + f{i}(1, 2) + C{i}().get(3);' for i in range(nfuncs))
+    lines.append('print total;')
+    return '\n'.join(lines) + '\n'
+
+def load_workloads(names=None):
+    workloads = { }
+    for filename in sorted(os.listdir(WORKLOADS)):
+        name, ext = os.path.splitext(filename)
+        if ext == '.lox':
+            with open(os.path.join(WORKLOADS, filename)) as file:
+                workloads[name] = file.read()
+    workloads['generated'] = generated_source()
+    if names:
+        unknown = set(names) - set(workloads)
+        if unknown:
+            raise SystemExit(f'Unknown benchmark(s): {", ".join(sorted(unknown))}')
+        workloads = { name: workloads[name] for name in names }
+    return workloads
+
+# Run a program once, returning a dict of phase -> seconds
+def time_phases(source):
+    context = loxcontext.LoxContext(output=io.BytesIO())
+    context.parse(source)
+    context.run()
+    if context.have_errors:
+        raise RuntimeError(f'Benchmark failed: {context.diagnostics}')
+    return { phase: context.metrics[f'{phase}_time'] for phase in PHASES }
+
+def run_benchmark(source, repeat=5, warmup=1):
+    for _ in range(warmup):
+        time_phases(source)
+    runs = [ time_phases(source) for _ in range(repeat) ]
+    result = { }
+    for phase in PHASES:
+        times = [ run[phase] for run in runs ]
+        result[phase] = { 'min': min(times), 'median': statistics.median(times), 'times': times }
+    return result
+
+def run_all(workloads, repeat=5, warmup=1, file=sys.stdout):
+    results = {
+        'python': sys.version,
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeat': repeat,
+        'warmup': warmup,
+        'benchmarks': { },
+        }
+    print(f'{"benchmark":<12}' + ''.join(f'{phase:>12}' for phase in PHASES), file=file)
+    for name, source in workloads.items():
+        result = results['benchmarks'][name] = run_benchmark(source, repeat, warmup)
+        print(f'{name:<12}' + ''.join(f'{result[phase]["min"]:12.6f}' for phase in PHASES), file=file)
+    return results
+
+# Compare results against a baseline.  Returns a list of (name, phase, base
+# time, new time) for the phases that got slower by more than threshold.
+def compare(results, baseline, threshold=0.1, file=sys.stdout):
+    regressions = [ ]
+    print(f'{"benchmark":<12}{"phase":<10}{"baseline":>12}{"current":>12}{"change":>10}', file=file)
+    for name, result in results['benchmarks'].items():
+        base = baseline['benchmarks'].get(name)
+        if not base:
+            continue
+        for phase in PHASES:
+            old, new = base[phase]['min'], result[phase]['min']
+            if max(old, new) < NOISE_FLOOR:
+                continue
+            change = new / old - 1
+            flag = ''
+            if change > threshold:
+                regressions.append((name, phase, old, new))
+                flag = '  REGRESSION'
+            print(f'{name:<12}{phase:<10}{old:12.6f}{new:12.6f}{change:+10.1%}{flag}', file=file)
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='timed runs per benchmark')
+    parser.add_argument('-w', '--warmup', type=int, default=1, help='untimed runs per benchmark')
+    parser.add_argument('-o', '--output', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against results saved earlier')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression (default 0.1 = 10%%)')
+    args = parser.parse_args(argv)
+
+    results = run_all(load_workloads(args.names), args.repeat, args.warmup)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        print()
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f'\n{len(regressions)} regression(s)')
+            return 1
+    return 0
+
+def test_harness():
+    out = io.StringIO()
+    results = run_all({ 'generated': generated_source(20) }, repeat=2, warmup=0, file=out)
+    result = results['benchmarks']['generated']
+    assert all(len(result[phase]['times']) == 2 for phase in PHASES)
+    baseline = json.loads(json.dumps(results))
+    for phase in PHASES:
+        baseline['benchmarks']['generated'][phase]['min'] = result[phase]['min'] / 2 + NOISE_FLOOR / 2
+    regressions = compare(results, baseline, file=out)
+    assert all(name == 'generated' for name, *_ in regressions)
@@ -2,34 +2,70 @@
 #
 # Main program
 
+import argparse
 import sys
 
 import loxcontext
+import loxcoverage
+import loxsample
 
 def main(argv):
-    if len(argv) > 2:
-        raise SystemExit(f'Usage: lox.py filename')
+    if len(argv) > 1 and argv[1] == '--server':
+        import loxserver
+        return loxserver.main(argv[2:])
+
+    parser = argparse.ArgumentParser(prog='lox.py', usage='%(prog)s [options] [filename] | --server [options]')
+    parser.add_argument('filename', nargs='?', help='program to run (default: interactive prompt)')
+    parser.add_argument('--profile', action='store_true', help='print a profile of the program to stderr')
+    parser.add_argument('--profile-output', metavar='FILE', help='save the profile to FILE in pstats format')
+    parser.add_argument('--sample', metavar='FILE', help='sample the Lox call stack and save it to FILE '
+                        'in collapsed-stack (flame graph) format')
+    parser.add_argument('--coverage', metavar='FILE', help='record statement and branch coverage, merging it '
+                        'into FILE (see loxcoverage)')
+    parser.add_argument('--lcov', metavar='FILE', help='write the coverage data in FILE as an LCOV tracefile '
+                        'to stdout')
+    parser.add_argument('--restore', metavar='FILE', help='load the globals saved in a heap snapshot first')
+    parser.add_argument('--snapshot', metavar='FILE', help='save the globals to a heap snapshot after running')
+    args = parser.parse_args(argv[1:])
+
+    if args.lcov:
+        loxcoverage.write_lcov(loxcoverage.load(args.lcov), sys.stdout)
+        return
 
     context = loxcontext.LoxContext()
-    if len(sys.argv) == 2:
-        with open(argv[1]) as file:
+    if args.restore:
+        context.restore(args.restore)
+    if args.filename:
+        with open(args.filename) as file:
             source = file.read()
-        context.parse(source)
-        context.run()
+        context.parse(source, args.filename)
+        profile = args.profile or args.profile_output is not None
+        coverage = args.coverage is not None
+        if args.sample:
+            with loxsample.LoxSampler(context) as sampler:
+                context.run(profile=profile, coverage=coverage)
+            with open(args.sample, 'w') as file:
+                sampler.write_collapsed(file)
+        else:
+            context.run(profile=profile, coverage=coverage)
+        # There's no profile if the program had errors before it could run
+        if args.profile and context.profiler:
+            context.profiler.print_report()
+        if args.profile_output and context.profiler:
+            context.profiler.dump_stats(args.profile_output)
+        if coverage and context.coverage:
+            loxcoverage.update(context.coverage.data(), args.coverage)
+        if args.snapshot and not context.have_errors:
+            context.snapshot(args.snapshot)
     else:
         try:
             while True:
                 source = input("Lox > ")
                 context.parse(source)
-                if not context.have_errors:
-                    for stmt in context.ast.statements:
-                        context.ast = stmt
-                        context.run()
+                context.run()
         except EOFError:
             pass
 
 if __name__ == '__main__':
     import sys
     main(sys.argv)
-    
-    
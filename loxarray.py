@@ -0,0 +1,220 @@
+# loxarray.py
+#
+# Numeric arrays.  Array(n) makes an array of n zeros.  Elements are floats.
+# Arrays support +, -, * and / elementwise, with another array of the same
+# length or with a number, and these methods:
+#
+#     a.get(i)         element i
+#     a.set(i, x)      set element i to x (returns x)
+#     a.length()       number of elements
+#     a.sum(), a.min(), a.max()
+#     a.dot(b)         dot product
+#     a.copy()         a new array with the same elements
+#
+# The elements are stored in a NumPy array so operations on whole arrays run
+# at native speed.  If NumPy isn't installed, an array.array('d') is used
+# instead and whole-array operations are done in Python.  NumPy is imported
+# when the first array is made, so programs that don't use arrays don't pay
+# for importing it.
+#
+# With memory accounting, arrays (including the results of operations on
+# them) are charged ELEMENT_SIZE bytes per element.
+
+import array
+import math
+import operator
+
+from loxnative import LoxNativeObject, LoxNativeError, native, is_integer
+import loxmemory
+
+# The numpy module (None if it isn't installed).  Set by _load_numpy().
+numpy = None
+_numpy_loaded = False
+
+def _load_numpy():
+    global numpy, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_loaded = True
+
+# Operators that work on arrays
+_operators = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    }
+
+class LoxArray(LoxNativeObject):
+    lox_methods = ('get', 'set', 'length', 'sum', 'min', 'max', 'dot', 'copy')
+    base_size = loxmemory.ARRAY_SIZE
+    item_size = loxmemory.ELEMENT_SIZE
+
+    def __init__(self, data):
+        self.data = data
+
+    def __setstate__(self, state):
+        _load_numpy()
+        self.__dict__.update(state)
+
+    def __str__(self):
+        return '[' + ', '.join(str(float(x)) for x in self.data) + ']'
+
+    def __len__(self):
+        return len(self.data)
+
+    def _index(self, index):
+        if not is_integer(index):
+            raise LoxNativeError('Array index must be an integer')
+        if not 0 <= index < len(self.data):
+            raise LoxNativeError('Array index out of range')
+        return int(index)
+
+    def get(self, index):
+        return float(self.data[self._index(index)])
+
+    def set(self, index, value):
+        if type(value) is not float:
+            raise LoxNativeError('Array elements must be numbers')
+        self.data[self._index(index)] = value
+        return value
+
+    def length(self):
+        return float(len(self.data))
+
+    def sum(self):
+        return float(sum(self.data) if numpy is None else self.data.sum())
+
+    def min(self):
+        self._check_not_empty('min')
+        return float(min(self.data) if numpy is None else self.data.min())
+
+    def max(self):
+        self._check_not_empty('max')
+        return float(max(self.data) if numpy is None else self.data.max())
+
+    def dot(self, other):
+        if not isinstance(other, LoxArray):
+            raise LoxNativeError('dot() argument must be an array')
+        self._check_length(other)
+        if numpy is None:
+            return float(math.fsum(map(operator.mul, self.data, other.data)))
+        return float(numpy.dot(self.data, other.data))
+
+    def copy(self):
+        result = LoxArray(None)
+        if self.memory:
+            result.charge(self.memory, len(self.data))
+        result.data = self.data.copy() if numpy is not None else array.array('d', self.data)
+        return result
+
+    def _check_not_empty(self, name):
+        if not len(self.data):
+            raise LoxNativeError(f'{name}() of an empty array')
+
+    def _check_length(self, other):
+        if len(self.data) != len(other.data):
+            raise LoxNativeError('Array lengths differ')
+
+# Charged before the elements are allocated, so that a huge array fails
+# with a quota error instead of running out of memory
+@native(arity=1, interp=True)
+def Array(interp, n):
+    if not is_integer(n) or n < 0:
+        raise LoxNativeError('Array size must be a non-negative integer')
+    _load_numpy()
+    result = LoxArray(None)
+    if interp.memory:
+        result.charge(interp.memory, int(n))
+    if numpy is None:
+        result.data = array.array('d', bytes(8 * int(n)))
+    else:
+        result.data = numpy.zeros(int(n))
+    return result
+
+# Division by zero gives an infinity or nan, as with NumPy
+def _divide(x, y):
+    if y:
+        return x / y
+    elif x and not math.isnan(x):
+        return math.copysign(math.inf, x) * math.copysign(1.0, y)
+    return math.nan
+
+# Apply a binary operator to operands at least one of which is an array.
+# Raises LoxNativeError if the operator doesn't work on arrays or the operands
+# aren't compatible.
+def operate(op, left, right):
+    func = _operators.get(op)
+    if func is None:
+        raise LoxNativeError(f'{op} operands must be numbers')
+    left = _operand(op, left)
+    right = _operand(op, right)
+    if not isinstance(left, float) and not isinstance(right, float) and len(left) != len(right):
+        raise LoxNativeError('Array lengths differ')
+    if numpy is not None:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return LoxArray(func(left, right))
+    if func is operator.truediv:
+        func = _divide
+    if isinstance(left, float):
+        return LoxArray(array.array('d', [ func(left, y) for y in right ]))
+    elif isinstance(right, float):
+        return LoxArray(array.array('d', [ func(x, right) for x in left ]))
+    else:
+        return LoxArray(array.array('d', map(func, left, right)))
+
+def _operand(op, value):
+    if isinstance(value, LoxArray):
+        return value.data
+    elif type(value) is float:
+        return value
+    raise LoxNativeError(f'{op} operands must be numbers or arrays')
+
+def test_array():
+    import io
+    import loxcontext
+    global numpy
+    source = '''
+var a = Array(4);
+var b = Array(4);
+for (var i = 0; i < 4; i = i + 1) { a.set(i, i); b.set(i, 10); }
+var c = (a + b) * 2 - 1;
+print c;
+print c.get(3);
+print c.length();
+print c.sum();
+print a.dot(b);
+print (1 / a).get(0);
+print a.max() + a.min();
+print a.copy() == a;
+'''
+    expected = b'[19.0, 21.0, 23.0, 25.0]\n25.0\n4.0\n88.0\n60.0\ninf\n3.0\nFalse\n'
+    _load_numpy()
+    saved = numpy
+    try:
+        for backend in (saved, None):
+            numpy = backend
+            out = io.BytesIO()
+            context = loxcontext.LoxContext(output=out)
+            context.parse(source)
+            context.run()
+            assert out.getvalue() == expected
+            for stackless in (False, True):
+                assert (loxcontext._diagnose('var a = Array(2); print a + Array(3);', stackless=stackless)
+                        == [(1, 'Array lengths differ')])
+    finally:
+        numpy = saved
+
+    for source, message in [('Array(2).get(2);', 'Array index out of range'),
+                            ('Array(2).foo();', "Undefined property 'foo'"),
+                            ('Array(2) < 1;', '< operands must be numbers'),
+                            ('Array((1 / Array(1)).get(0));', 'Array size must be a non-negative integer'),
+                            ('Array(2).get((0 / Array(1)).get(0));', 'Array index must be an integer')]:
+        assert loxcontext._diagnose(source) == [(1, message)]
+
+    # Arrays and the results of operations on them count against the quota
+    for source in ['Array(1000000);', 'var a = Array(100000); var b = a + 1; var c = b.copy();']:
+        assert loxcontext._diagnose(source, max_memory=2000000) == [(1, 'Memory quota of 2000000 bytes exceeded')]
@@ -3,9 +3,11 @@
 class Node:
     # Track define AST node-names for some later sanity checks
     _nodenames = set()
+    _nodetypes = [ ]
     @classmethod
     def __init_subclass__(cls):
         Node._nodenames.add(cls.__name__)
+        Node._nodetypes.append(cls)
 
     _fields = []
     def __init__(self, *args):
@@ -20,6 +22,13 @@ class Node:
     def __eq__(self, other):
         return type(self) == type(other) and vars(self) == vars(other)
 
+    # Change the class of a node in-place (for specialization).  Node identity
+    # is preserved.  The attribute dict is rebuilt since CPython's attribute
+    # access is much slower on instances whose class was changed.
+    def become(self, cls):
+        self.__class__ = cls
+        self.__dict__ = dict(self.__dict__)
+
 # -- Expressions represent values
 class Expression(Node):
     pass
@@ -94,6 +103,112 @@ class FuncDeclaration(Declaration):
 
 class ClassDeclaration(Declaration):
     _fields = ['name', 'superclass', 'methods']
+
+# -- Specialized nodes.  These are never produced by the parser.  After
+# resolution, loxspecialize changes the class of nodes in-place to one of these
+# subclasses so that the interpreter dispatches directly to the right code.
+#
+# Binary/Unary nodes by operator
+class Add(Binary):
+    pass
+
+class Subtract(Binary):
+    pass
+
+class Multiply(Binary):
+    pass
+
+class Divide(Binary):
+    pass
+
+class Less(Binary):
+    pass
+
+class LessEqual(Binary):
+    pass
+
+class Greater(Binary):
+    pass
+
+class GreaterEqual(Binary):
+    pass
+
+class Equal(Binary):
+    pass
+
+class NotEqual(Binary):
+    pass
+
+class Negate(Unary):
+    pass
+
+class Not(Unary):
+    pass
+
+# Variable access by storage class (as determined by the resolver).  The slot
+# attribute gives the frame slot or upvalue index.
+class LocalVariable(Variable):
+    pass
+
+class CellVariable(Variable):
+    pass
+
+class UpvalueVariable(Variable):
+    pass
+
+class GlobalVariable(Variable):
+    pass
+
+class LocalAssign(Assign):
+    pass
+
+class CellAssign(Assign):
+    pass
+
+class UpvalueAssign(Assign):
+    pass
+
+class GlobalAssign(Assign):
+    pass
+
+# return f(args) in tail position.  The call reuses the caller's invocation.
+class TailReturn(Return):
+    pass
+
+# -- Quickened nodes.  The interpreter rewrites nodes to these classes in-place
+# the first time they execute, based on what it observes.  If an assumption
+# fails later, the node is rewritten to a generic version that stays put.
+class FunctionCall(Call):
+    pass
+
+class NativeCall(Call):
+    pass
+
+class GenericCall(Call):
+    pass
+
+class FloatAdd(Add):
+    pass
+
+class StringAdd(Add):
+    pass
+
+class GenericAdd(Add):
+    pass
+
+# -- Generic traversal
+def iter_children(node):
+    for name in node._fields:
+        value = getattr(node, name)
+        if isinstance(value, Node):
+            yield value
+        elif isinstance(value, list):
+            yield from (item for item in value if isinstance(item, Node))
+
+def walk(node):
+    yield node
+    for child in iter_children(node):
+        yield from walk(child)
     
 # -- Visitor class
 class NodeVisitor:
@@ -102,10 +217,24 @@ class NodeVisitor:
         # Verify that any visit_* method actually corresponds to the name of an AST node.
         visitors = { key for key in cls.__dict__ if key.startswith('visit_') }
         assert all(key[6:] in Node._nodenames for key in visitors)
-        
+        cls._visitors = { }
+
     def visit(self, node):
-        method = f'visit_{type(node).__name__}'
-        return getattr(self, method)(node)
+        method = self._visitors.get(type(node))
+        if method is None:
+            method = self._find_visitor(type(node))
+        return method(self, node)
+
+    # Find the visit_* method for a node type, falling back to the visitor for a
+    # base class (so that specialized nodes work with any visitor).
+    @classmethod
+    def _find_visitor(cls, nodetype):
+        for base in nodetype.__mro__:
+            method = getattr(cls, f'visit_{base.__name__}', None)
+            if method:
+                cls._visitors[nodetype] = method
+                return method
+        raise AttributeError(f'{cls.__name__} has no visit_{nodetype.__name__}')
 
 # Debugging class for turning the AST into S-expressions
 class ASTPrinter(NodeVisitor):
@@ -0,0 +1,87 @@
+# loxasync.py
+#
+# Runs Lox programs as asyncio tasks so that many of them can be interleaved
+# on a single event loop.  A program runs in its context's suspendable
+# interpreter (see loxgeninterp) and gives up control every tick_chunk steps
+# and whenever it calls an async native such as sleep().  A program stuck in
+# a loop therefore can't starve the others.
+#
+#     contexts = [ ... LoxContext objects that have parsed programs ... ]
+#     asyncio.run(loxasync.run_all(contexts, timeout=5.0))
+
+import asyncio
+import time
+
+async def run(context, max_steps=None, timeout=None, tick_chunk=1000):
+    if context.interp.gettrace():
+        raise ValueError("Can't trace in async mode")
+    if context.have_errors:
+        return
+    interp = context.interp
+    steps = interp.interpret_steps(context.ast, max_steps, timeout, tick_chunk)
+    value = error = None
+    try:
+        while True:
+            try:
+                if error is None:
+                    request = steps.send(value)
+                else:
+                    request = steps.throw(error)
+            except StopIteration:
+                return
+            value = error = None
+            if request is None:
+                # Time slice used up
+                await asyncio.sleep(0)
+            else:
+                # Awaitable from an async native.  Exceptions are raised in
+                # the program at the point of the call.
+                try:
+                    if interp.deadline is not None:
+                        request = asyncio.wait_for(request, max(interp.deadline - time.monotonic(), 0))
+                    value = await request
+                except Exception as err:
+                    error = err
+    finally:
+        steps.close()
+        context.output.flush()
+
+# Run several contexts concurrently until they're all finished
+async def run_all(contexts, max_steps=None, timeout=None, tick_chunk=1000):
+    await asyncio.gather(*(run(context, max_steps, timeout, tick_chunk) for context in contexts))
+
+def test_run_all():
+    import io
+    import loxcontext
+    log = [ ]
+    contexts = [ ]
+    for name, source in [('a', 'var i = 0; while (i < 3) { log(i); i = i + 1; }'),
+                         ('b', 'fun f(n) { log(n); if (n > 0) f(n - 1); } f(2);'),
+                         ('c', 'sleep(0.01); log(0); while (true) { }')]:
+        context = loxcontext.LoxContext(output=io.BytesIO(), errors=io.StringIO())
+        context.define_native('log', lambda n, name=name: log.append(f'{name}{n:g}'))
+        context.parse(source)
+        contexts.append(context)
+    asyncio.run(run_all(contexts, max_steps=10, tick_chunk=1))
+    assert log == ['a0', 'a1', 'b2', 'a2', 'b1', 'b0', 'c0']
+    assert contexts[2].diagnostics == [(1, 'Step limit exceeded')]
+
+    context = loxcontext.LoxContext(output=io.BytesIO(), errors=io.StringIO())
+    context.parse('sleep(1);')
+    asyncio.run(context.run_async(timeout=0.01))
+    assert context.diagnostics == [(1, 'Time limit exceeded')]
+
+    # Errors in async natives are reported without stopping the other programs
+    async def fail():
+        raise OSError('no such thing')
+    contexts = [ ]
+    out = io.BytesIO()
+    for source in ['sleep(nil);', 'fail();', 'sleep(0); print "ok";']:
+        context = loxcontext.LoxContext(output=out, errors=io.StringIO())
+        context.define_native('fail', fail)
+        context.parse(source)
+        contexts.append(context)
+    asyncio.run(run_all(contexts))
+    assert contexts[0].diagnostics == [(1, 'sleep() argument must be a non-negative number')]
+    assert contexts[1].diagnostics == [(1, 'fail() failed: OSError: no such thing')]
+    assert out.getvalue() == b'ok\n'
@@ -0,0 +1,168 @@
+# loxcollections.py
+#
+# Native collection types.  List() makes an empty list and Map() an empty
+# map (hash table).  They're backed by a Python list and dict, so indexing
+# and lookups are O(1) and appends are amortized O(1).  Methods:
+#
+#     list.get(i)          element i
+#     list.set(i, x)       set element i to x (returns x)
+#     list.append(x)       add x to the end (returns x)
+#     list.pop()           remove and return the last element
+#     list.length()
+#
+#     map.get(key)         value for key (nil if there isn't one)
+#     map.set(key, x)      set the value for key to x (returns x)
+#     map.has(key)         whether key is in the map
+#     map.remove(key)      remove key and return its value (nil if there isn't one)
+#     map.keys()           List of the keys, in the order they were added
+#     map.length()
+#
+# Any value can be used as a key.  Strings and numbers are compared by value
+# and everything else by identity, as with ==.  (1 and true are different
+# keys.)
+#
+# With memory accounting, collections are charged for each element or entry
+# as it's added.
+
+from loxnative import LoxNativeObject, LoxNativeError, native, is_integer
+import loxmemory
+
+class LoxList(LoxNativeObject):
+    lox_methods = ('get', 'set', 'append', 'pop', 'length')
+    base_size = loxmemory.LIST_SIZE
+    item_size = loxmemory.ELEMENT_SIZE
+
+    def __init__(self, items=None):
+        self.items = items if items is not None else [ ]
+
+    def __str__(self):
+        return '[' + ', '.join(map(str, self.items)) + ']'
+
+    def _index(self, index):
+        if not is_integer(index):
+            raise LoxNativeError('List index must be an integer')
+        if not 0 <= index < len(self.items):
+            raise LoxNativeError('List index out of range')
+        return int(index)
+
+    def get(self, index):
+        return self.items[self._index(index)]
+
+    def set(self, index, value):
+        self.items[self._index(index)] = value
+        return value
+
+    def append(self, value):
+        self.grow(1)
+        self.items.append(value)
+        return value
+
+    def pop(self):
+        if not self.items:
+            raise LoxNativeError('pop() from an empty list')
+        self.grow(-1)
+        return self.items.pop()
+
+    def length(self):
+        return float(len(self.items))
+
+# Key for a value in a map's dict.  Python considers 1.0 and True equal, so
+# numbers and booleans are keyed with their type.
+def _key(key):
+    if type(key) is float or type(key) is bool:
+        return (type(key), key)
+    return key
+
+class LoxMap(LoxNativeObject):
+    lox_methods = ('get', 'set', 'has', 'remove', 'keys', 'length')
+    base_size = loxmemory.MAP_SIZE
+    item_size = loxmemory.ENTRY_SIZE
+
+    def __init__(self):
+        self.entries = { }               # _key(key) -> (key, value)
+
+    def __str__(self):
+        return '{' + ', '.join(f'{key}: {value}' for key, value in self.entries.values()) + '}'
+
+    def get(self, key):
+        entry = self.entries.get(_key(key))
+        return entry[1] if entry else None
+
+    def set(self, key, value):
+        k = _key(key)
+        if k not in self.entries:
+            self.grow(1)
+        self.entries[k] = (key, value)
+        return value
+
+    def has(self, key):
+        return _key(key) in self.entries
+
+    def remove(self, key):
+        entry = self.entries.pop(_key(key), None)
+        if not entry:
+            return None
+        self.grow(-1)
+        return entry[1]
+
+    def keys(self):
+        result = LoxList([ key for key, _ in self.entries.values() ])
+        return result.charge(self.memory, len(result.items)) if self.memory else result
+
+    def length(self):
+        return float(len(self.entries))
+
+@native(arity=0, interp=True)
+def List(interp):
+    result = LoxList()
+    return result.charge(interp.memory, 0) if interp.memory else result
+
+@native(arity=0, interp=True)
+def Map(interp):
+    result = LoxMap()
+    return result.charge(interp.memory, 0) if interp.memory else result
+
+def test_collections():
+    import io
+    import loxcontext
+    source = '''
+var list = List();
+for (var i = 0; i < 5; i = i + 1) list.append(i * i);
+list.set(0, "zero");
+print list;
+print list.pop() + list.length();
+var counts = Map();
+var words = List();
+words.append("a"); words.append("b"); words.append("a");
+for (var i = 0; i < words.length(); i = i + 1) {
+  var word = words.get(i) + "";
+  if (counts.has(word)) counts.set(word, counts.get(word) + 1); else counts.set(word, 1);
+}
+print counts;
+print counts.get("c");
+print counts.remove("a");
+print counts.keys();
+'''
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.parse(source)
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'[zero, 1.0, 4.0, 9.0, 16.0]\n20.0\n{a: 2.0, b: 1.0}\nNone\n2.0\n[b]\n'
+
+    for source, message in [('List().get(0);', 'List index out of range'),
+                            ('List().get((0 / Array(1)).get(0));', 'List index must be an integer'),
+                            ('List().pop();', 'pop() from an empty list'),
+                            ('Map().length(1);', 'Expected 0 arguments')]:
+        assert loxcontext._diagnose(source) == [(1, message)]
+
+    out = io.BytesIO()
+    context = loxcontext.LoxContext(output=out)
+    context.parse('var m = Map(); m.set(1, "one"); m.set(true, "true"); m.set(nil, "nil"); print m; print m.get(1);')
+    context.run()
+    assert out.getvalue() == b'{1.0: one, True: true, None: nil}\none\n'
+
+    # Elements and entries count against the quota
+    for source in ['var l = List(); while (true) l.append(nil);',
+                   'var m = Map(); var i = 0; while (true) { m.set(i, i); i = i + 1; }']:
+        assert loxcontext._diagnose(source, max_memory=100000) == [(1, 'Memory quota of 100000 bytes exceeded')]
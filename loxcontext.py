@@ -4,29 +4,180 @@
 # program.  Serves as a repository for information about the program include
 # source code, error reporting, etc.
 
+import sys
+import time
 
 import loxscan
 import loxparse
-import loxinterp
+import loxgeninterp
+import loxoptimize
+import loxresolve
+import loxnative
+import loxmemory
 import loxast
+import loxprofile
+import loxcoverage
+import loxmetrics
+import loxvector
+import loxcollections
+import loxsnapshot
+
+# Buffered sink for program output.  Text is collected in memory and written
+# out in large chunks.  If stream is given, it must be a binary stream.
+# Otherwise output goes to whatever sys.stdout is at the time of the flush.
+class LoxOutput:
+    def __init__(self, stream=None, bufsize=65536, encoding='utf-8'):
+        self.stream = stream
+        self.bufsize = bufsize
+        self.encoding = encoding
+        self.buffer = [ ]
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = ''.join(self.buffer)
+        self.buffer.clear()
+        self.size = 0
+        if self.stream is None:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        else:
+            self.stream.write(data.encode(self.encoding))
+            self.stream.flush()
 
 class LoxContext:
-    def __init__(self):
+    def __init__(self, optimize=True, output=None, bufsize=65536, max_memory=None, track_memory=False,
+                 errors=None, metrics=False, metrics_hook=None):
+        self.output = LoxOutput(output, bufsize)
+        self.errors = errors
+        self.diagnostics = [ ]
         self.lexer = loxscan.LoxLexer(self)
         self.parser = loxparse.LoxParser(self)
-        self.interp = loxinterp.LoxInterpreter(self)
+        self.interp = loxgeninterp.LoxGenInterpreter(self)
+        if track_memory or max_memory is not None:
+            self.interp.memory = loxmemory.LoxMemory(max_memory)
+        self.optimize = optimize
         self.source = ''
+        self.filename = '<string>'
         self.ast = None
+        self.profiler = None
+        self.coverage = None
         self.have_errors = False
+        # Metrics (see loxmetrics).  If given, metrics_hook(event, metrics) is
+        # called at the end of parse() and run() with event 'parse' or 'run'.
+        self.metrics = { }
+        self.collect_metrics = metrics
+        self.metrics_hook = metrics_hook
 
-    def parse(self, source):
+    def parse(self, source, filename='<string>'):
         self.have_errors = False
+        self.diagnostics = [ ]
         self.source = source
-        self.ast = self.parser.parse(self.lexer.tokenize(self.source))
+        self.filename = filename
+        metrics = self.metrics = { }
+        start = time.perf_counter()
+        tokens = list(self.lexer.tokenize(self.source))
+        lexed = time.perf_counter()
+        if self.collect_metrics:
+            self.ast = self.parser.parse_counted(iter(tokens))
+            metrics['reductions'] = self.parser.reductions
+        else:
+            self.ast = self.parser.parse(iter(tokens))
+        if self.optimize and not self.have_errors:
+            # Errors in code the optimizer removes are still reported
+            loxresolve.check(self.ast, self.interp.resolve_env, self)
+        if self.optimize and not self.have_errors:
+            self.ast = loxoptimize.optimize(self.ast, self)
+        metrics['tokens'] = len(tokens)
+        metrics['lex_time'] = lexed - start
+        metrics['parse_time'] = time.perf_counter() - lexed
+        if self.collect_metrics:
+            metrics['nodes'] = sum(1 for _ in loxast.walk(self.ast)) if self.ast else 0
+        if self.metrics_hook:
+            self.metrics_hook('parse', metrics)
 
-    def run(self):
+    # Run the program.  max_steps limits the number of loop iterations plus
+    # function calls.  timeout limits the run time in seconds.  Exceeding
+    # either stops the program with an error.  If stackless is set, Lox calls
+    # don't use the Python stack so deep recursion works (see loxgeninterp).
+    # If profile is set, a profile of the run is left in self.profiler (see
+    # loxprofile).  If coverage is set, the statements and branches that ran
+    # are left in self.coverage (see loxcoverage).  Neither is supported in
+    # stackless mode, and neither is tracing (LoxInterpreter.settrace).
+    def run(self, max_steps=None, timeout=None, stackless=False, profile=False, coverage=False):
+        if profile and stackless:
+            raise ValueError("Can't profile in stackless mode")
+        if coverage and stackless:
+            raise ValueError("Can't measure coverage in stackless mode")
+        if stackless and self.interp.gettrace():
+            raise ValueError("Can't trace in stackless mode")
         if not self.have_errors:
-            return self.interp.interpret(self.ast)
+            counters = loxmetrics.LoxCounters() if self.collect_metrics and not stackless else None
+            if counters:
+                counters.install(self.interp)
+            if profile:
+                self.profiler = loxprofile.LoxProfiler(self)
+                self.profiler.install(self.interp)
+            if coverage:
+                self.coverage = loxcoverage.LoxCoverage(self)
+                self.coverage.install(self.interp)
+            start = time.perf_counter()
+            try:
+                if stackless:
+                    return self.interp.interpret_stackless(self.ast, max_steps, timeout)
+                return self.interp.interpret(self.ast, max_steps, timeout)
+            finally:
+                elapsed = time.perf_counter() - start
+                if coverage:
+                    self.coverage.uninstall(self.interp)
+                if profile:
+                    self.profiler.uninstall(self.interp)
+                if counters:
+                    counters.uninstall(self.interp)
+                    self.metrics.update(counters.as_dict())
+                self.output.flush()
+                self.metrics['resolve_time'] = self.interp.resolve_time
+                self.metrics['exec_time'] = elapsed - self.interp.resolve_time
+                if self.metrics_hook:
+                    self.metrics_hook('run', self.metrics)
+
+    # Run the program as a coroutine that lets other tasks run every
+    # tick_chunk steps and while waiting on async natives (see loxasync)
+    async def run_async(self, max_steps=None, timeout=None, tick_chunk=1000):
+        import loxasync          # Only programs run this way need asyncio
+        return await loxasync.run(self, max_steps, timeout, tick_chunk)
+
+    # Save the program's global variables and everything they refer to, to a
+    # file (a filename or a binary file object).  restore() loads them into
+    # another context.  See loxsnapshot.
+    def snapshot(self, file):
+        if isinstance(file, str):
+            with open(file, 'wb') as f:
+                return loxsnapshot.save(self, f)
+        return loxsnapshot.save(self, file)
+
+    def restore(self, file):
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                return loxsnapshot.load(self, f)
+        return loxsnapshot.load(self, file)
+
+    # Approximate number of bytes currently allocated by the program (None if
+    # memory accounting isn't enabled)
+    @property
+    def memory_used(self):
+        return self.interp.memory.live if self.interp.memory else None
+
+    # Make a Python function callable from Lox code under the given name
+    def define_native(self, name, func, arity=None):
+        self.interp.define_global(name, loxnative.new_native(name, func, arity))
 
     def find_source(self, node):
         indices = self.parser.index_position(node)
@@ -35,22 +186,79 @@ class LoxContext:
         else:
             return f'{type(node).__name__} (source unavailable)'
         
+    # Report an error.  Messages are printed to the errors stream (sys.stdout by
+    # default) and recorded as (lineno, message) in self.diagnostics.
     def error(self, position, message):
+        self.output.flush()
+        file = self.errors if self.errors is not None else sys.stdout
         if isinstance(position, loxast.Node):
-            lineno = self.parser.line_position(position)
-            (start, end) = (part_start, part_end) = self.parser.index_position(position)
-            while start >= 0 and self.source[start] != '\n':
-                start -=1
-
-            start += 1
-            while end < len(self.source) and self.source[end] != '\n':
-                end += 1
-            print()
-            print(self.source[start:end])
-            print(" "*(part_start - start), end='')
-            print("^"*(part_end - part_start))
-            print(f'{lineno}: {message}')
+            # Nodes made up after parsing may not have a position
+            try:
+                lineno = self.parser.line_position(position)
+                indices = self.parser.index_position(position)
+            except (KeyError, AttributeError):
+                lineno = indices = None
+            if indices:
+                (start, end) = (part_start, part_end) = indices
+                while start >= 0 and self.source[start] != '\n':
+                    start -=1
+
+                start += 1
+                while end < len(self.source) and self.source[end] != '\n':
+                    end += 1
+                print(file=file)
+                print(self.source[start:end], file=file)
+                print(" "*(part_start - start), end='', file=file)
+                print("^"*(part_end - part_start), file=file)
+            print(f'{lineno if lineno is not None else "?"}: {message}', file=file)
             
         else:
-            print(f'{position}: {message}')
+            lineno = position
+            print(f'{position}: {message}', file=file)
+        self.diagnostics.append((lineno, message))
         self.have_errors = True
+
+# Run source with its output and error messages discarded and return the
+# diagnostics.  For tests.
+def _diagnose(source, max_memory=None, **options):
+    import io
+    context = LoxContext(output=io.BytesIO(), errors=io.StringIO(), max_memory=max_memory)
+    context.parse(source)
+    context.run(**options)
+    return context.diagnostics
+
+def test_output():
+    import contextlib
+    import io
+    out = io.BytesIO()
+    output = LoxOutput(out, bufsize=8)
+    output.write('abc\n')
+    assert out.getvalue() == b''
+    output.write('déf\n')
+    assert out.getvalue() == 'abc\ndéf\n'.encode('utf-8')
+    output.write('g\n')
+    output.flush()
+    assert out.getvalue().endswith(b'g\n')
+
+    # Without a stream, output goes to sys.stdout as of the flush
+    output = LoxOutput()
+    output.write('hello\n')
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        output.flush()
+    assert stdout.getvalue() == 'hello\n'
+
+    # Output is flushed at the end of a run and before an error is reported
+    class Errors(io.StringIO):
+        def write(self, text):
+            seen.append(out.getvalue())
+            return super().write(text)
+    seen = [ ]
+    out = io.BytesIO()
+    context = LoxContext(output=out, errors=Errors())
+    context.parse('print 1; print -nil;')
+    context.run()
+    assert seen[0] == b'1.0\n'
+    context.parse('print 2;')
+    context.run()
+    assert out.getvalue() == b'1.0\n2.0\n'
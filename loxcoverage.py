@@ -0,0 +1,250 @@
+# loxcoverage.py
+#
+# Statement and branch coverage.  Enabled with LoxContext.run(coverage=True).
+#
+# Nodes are numbered in the order loxast.walk() visits them, which is the
+# same in every process that parses the same source.  What ran is recorded
+# in a bytearray with one byte of flags per node, indexed by that number:
+#
+#     statements            EXECUTED
+#     if statements         TAKEN (consequence ran), NOT_TAKEN (it didn't)
+#     while loops           TAKEN (body ran), NOT_TAKEN (test was false)
+#     and/or                TAKEN (right side evaluated), NOT_TAKEN (short-circuited)
+#
+# Results are kept as coverage data, a dict mapping each filename to
+#
+#     { 'digest': sha256 of the source,
+#       'statements': [ [node number, line], ... ],
+#       'branches': [ [node number, line], ... ],
+#       'flags': bytes }
+#
+# Data from any number of runs (and processes) is merged by or-ing the
+# flags together (see combine()) and can be saved as JSON and written out
+# as an LCOV tracefile for genhtml and similar tools:
+#
+#     data = loxcoverage.combine([ loxcoverage.load(name) for name in filenames ])
+#     with open('lox.info', 'w') as file:
+#         loxcoverage.write_lcov(data, file)
+
+import base64
+import hashlib
+import json
+import os
+
+from loxast import Statement, Statements, ClassDeclaration, IfStmt, WhileStmt, Logical, walk
+from loxinterp import _is_truthy
+
+EXECUTED = 1
+TAKEN = 2
+NOT_TAKEN = 4
+
+class LoxCoverage:
+    def __init__(self, context):
+        self.context = context
+        self.filename = context.filename
+        self.statements = [ ]            # [node number, line]
+        self.branches = [ ]              # [node number, line]
+        self._numbers = { }              # id(node) -> node number
+        self._tests = { }                # id(expression) -> (node number, flag if truthy, flag if not)
+        methods = set()
+        for number, node in enumerate(walk(context.ast)):
+            self._numbers[id(node)] = number
+            if isinstance(node, ClassDeclaration):
+                # Methods are declared by the class, not executed
+                methods.update(id(meth) for meth in node.methods)
+            if isinstance(node, Statement) and not isinstance(node, Statements) and id(node) not in methods:
+                self.statements.append([number, self._line(node)])
+            if isinstance(node, (IfStmt, WhileStmt)):
+                self.branches.append([number, self._line(node)])
+                self._tests[id(node.test)] = (number, TAKEN, NOT_TAKEN)
+            elif isinstance(node, Logical):
+                # The right side is evaluated if the left side doesn't decide the result
+                self.branches.append([number, self._line(node)])
+                self._tests[id(node.left)] = (number, NOT_TAKEN, TAKEN) if node.op == 'or' else (number, TAKEN, NOT_TAKEN)
+        self.flags = bytearray(len(self._numbers))
+
+    # Line of a node.  Statements made up by the parser (e.g., the parts of a
+    # for loop) don't have a position, so the first part of them that does
+    # is used.
+    def _line(self, node):
+        for part in walk(node):
+            try:
+                return self.context.parser.line_position(part)
+            except KeyError:
+                pass
+        return 0
+
+    def install(self, interp):
+        interp.instrument(self._wrap)
+
+    def uninstall(self, interp):
+        interp.uninstrument()
+
+    # Branches are recorded when the expression deciding them is evaluated,
+    # so the if, while and and/or nodes themselves are run by method as usual
+    # (along with any other instrumentation under this).
+    def _wrap(self, nodetype, method):
+        numbers = self._numbers
+        tests = self._tests
+        flags = self.flags
+        if issubclass(nodetype, Statement):
+            if issubclass(nodetype, Statements):
+                return method
+            def visit_statement(interp, node):
+                # Statements from earlier runs (e.g., in functions they
+                # defined) aren't part of this program's coverage
+                number = numbers.get(id(node))
+                if number is not None:
+                    flags[number] |= EXECUTED
+                return method(interp, node)
+            return visit_statement
+        def visit_expression(interp, node):
+            value = method(interp, node)
+            branch = tests.get(id(node))
+            if branch:
+                number, truthy, falsy = branch
+                flags[number] |= truthy if _is_truthy(value) else falsy
+            return value
+        return visit_expression
+
+    # Coverage data for this run
+    def data(self):
+        return { self.filename: {
+            'digest': hashlib.sha256(self.context.source.encode('utf-8')).hexdigest(),
+            'statements': [ list(item) for item in self.statements ],
+            'branches': [ list(item) for item in self.branches ],
+            'flags': bytes(self.flags),
+            } }
+
+# Merge coverage data.  Data for the same file must come from the same source.
+def combine(datasets):
+    result = { }
+    for data in datasets:
+        for filename, filedata in data.items():
+            merged = result.get(filename)
+            if merged is None:
+                result[filename] = dict(filedata)
+            elif merged['digest'] != filedata['digest']:
+                raise ValueError(f'{filename}: coverage data is for a different version of the source')
+            else:
+                merged['flags'] = bytes(a | b for a, b in zip(merged['flags'], filedata['flags']))
+    return result
+
+def save(data, filename):
+    encoded = { name: dict(filedata, flags=base64.b64encode(filedata['flags']).decode('ascii'))
+                for name, filedata in data.items() }
+    with open(filename, 'w') as file:
+        json.dump(encoded, file)
+
+def load(filename):
+    with open(filename) as file:
+        encoded = json.load(file)
+    return { name: dict(filedata, flags=base64.b64decode(filedata['flags']))
+             for name, filedata in encoded.items() }
+
+# Merge data into a saved file (creating it if needed)
+def update(data, filename):
+    if os.path.exists(filename):
+        data = combine([load(filename), data])
+    save(data, filename)
+
+# Per-file summary: { filename: (statements, executed, branches, taken) }.
+# Each branch point counts as two branches.
+def summary(data):
+    result = { }
+    for filename, filedata in data.items():
+        flags = filedata['flags']
+        executed = sum(1 for number, _ in filedata['statements'] if flags[number] & EXECUTED)
+        taken = sum(bool(flags[number] & TAKEN) + bool(flags[number] & NOT_TAKEN)
+                    for number, _ in filedata['branches'])
+        result[filename] = (len(filedata['statements']), executed, 2 * len(filedata['branches']), taken)
+    return result
+
+def write_lcov(data, file):
+    for filename, filedata in sorted(data.items()):
+        flags = filedata['flags']
+        print('TN:', file=file)
+        print(f'SF:{filename}', file=file)
+        lines = { }
+        for number, line in filedata['statements']:
+            if line:
+                lines[line] = lines.get(line, 0) or flags[number] & EXECUTED
+        branches = 0
+        hit = 0
+        for number, line in filedata['branches']:
+            for branch, flag in enumerate((TAKEN, NOT_TAKEN)):
+                if not flags[number]:
+                    taken = '-'
+                else:
+                    taken = 1 if flags[number] & flag else 0
+                    hit += taken
+                branches += 1
+                print(f'BRDA:{line},{number},{branch},{taken}', file=file)
+        print(f'BRF:{branches}', file=file)
+        print(f'BRH:{hit}', file=file)
+        for line, executed in sorted(lines.items()):
+            print(f'DA:{line},{1 if executed else 0}', file=file)
+        print(f'LF:{len(lines)}', file=file)
+        print(f'LH:{sum(1 for executed in lines.values() if executed)}', file=file)
+        print('end_of_record', file=file)
+
+def test_coverage():
+    import io
+    import tempfile
+    import loxcontext
+    source = '''fun sign(x) {
+  if (x < 0) {
+    return -1;
+  } else {
+    return 1;
+  }
+}
+for (var i = 0; i < 2; i = i + 1) print sign(value()) > 0 or false;
+class A { unused() { print "never"; } }
+'''
+    runs = [ ]
+    for value in (1.0, -1.0):
+        context = loxcontext.LoxContext(output=io.BytesIO())
+        context.define_native('value', lambda value=value: value)
+        context.parse(source, 'sign.lox')
+        context.run(coverage=True)
+        runs.append(context.coverage.data())
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = f'{dirname}/coverage.json'
+        update(runs[0], filename)
+        assert summary(load(filename))['sign.lox'] == (10, 8, 6, 4)
+        update(runs[1], filename)
+        data = load(filename)
+    assert summary(data)['sign.lox'] == (10, 9, 6, 6)
+    out = io.StringIO()
+    write_lcov(data, out)
+    lcov = out.getvalue().splitlines()
+    assert 'DA:3,1' in lcov and 'DA:9,1' in lcov and 'LH:6' in lcov
+    assert 'BRH:6' in lcov
+
+    # Instrumentation installed before coverage still sees every statement
+    counts = [ ]
+    for coverage in (False, True):
+        context = loxcontext.LoxContext(output=io.BytesIO(), metrics=True)
+        context.define_native('value', lambda: 1.0)
+        context.parse(source, 'sign.lox')
+        context.run(coverage=coverage)
+        counts.append(context.metrics['statements'])
+    assert counts[0] == counts[1]
+
+    # Functions defined by an earlier run can be called
+    context = loxcontext.LoxContext(output=io.BytesIO())
+    context.parse('fun f(x) { if (x) return 1; return 2; }')
+    context.run()
+    context.parse('print f(true);')
+    context.run(coverage=True)
+    assert summary(context.coverage.data())['<string>'] == (1, 1, 0, 0)
+
+    changed = loxcontext.LoxContext(output=io.BytesIO())
+    changed.parse('print 1;', 'sign.lox')
+    changed.run(coverage=True)
+    try:
+        combine([data, changed.coverage.data()])
+        assert False, 'expected ValueError'
+    except ValueError:
+        pass
@@ -0,0 +1,357 @@
+# loxgeninterp.py
+#
+# Suspendable, non-recursive interpreter.  Runs a program as a Python
+# generator so that its execution can be paused and resumed (see loxasync).
+# Statements and expressions that might run for a long time, namely loops and
+# anything containing a call, are evaluated by gen_* methods which are
+# generators.  Everything else is evaluated by the ordinary recursive visit_*
+# methods, so straight-line code runs at full speed.
+#
+# A gen_* method evaluates a child by yielding the child's generator and
+# receiving its result.  The generators are run by a trampoline which keeps
+# them on an explicit stack (see _run_stack).  A Lox call therefore doesn't use
+# any Python stack, and Lox recursion depth is only limited by memory.
+#
+# The program as a whole yields at loop back-edges and function calls
+# whenever the tick budget (see LoxInterpreter.set_limits) runs out, and at
+# calls to async natives.  What's yielded is either None (time slice used up)
+# or an awaitable that must be awaited and its result sent back in.
+
+import types
+
+from loxast import iter_children, Statements, Call, WhileStmt, FuncDeclaration
+from loxinterp import (LoxInterpreter, LoxFunction, LoxClass, LoxMemoFunction, LoxCell, LoxExit, ReturnException,
+                       TailCall, _is_truthy, _missing, _numeric_operators)
+from loxnative import LoxAsyncNativeFunction, LoxNativeError, failure_message
+from loxmemory import LoxMemoryError
+import loxmemory
+
+# Mark each node with whether evaluating it might suspend (node.suspends).
+# Declaring a function doesn't run its body, so declarations never suspend.
+def mark_suspends(node):
+    suspends = False
+    for child in iter_children(node):
+        if mark_suspends(child):
+            suspends = True
+    if isinstance(node, (Call, WhileStmt)):
+        suspends = True
+    elif isinstance(node, FuncDeclaration):
+        suspends = False
+    node.suspends = suspends
+    return suspends
+
+class LoxGenInterpreter(LoxInterpreter):
+    _gen_visitors = { }
+
+    def gvisit(self, node):
+        method = self._gen_visitors.get(type(node))
+        if method is None:
+            method = self._find_gen_visitor(type(node))
+        return method(self, node)
+
+    @classmethod
+    def _find_gen_visitor(cls, nodetype):
+        for base in nodetype.__mro__:
+            method = getattr(cls, f'gen_{base.__name__}', None)
+            if method:
+                cls._gen_visitors[nodetype] = method
+                return method
+        raise AttributeError(f'{cls.__name__} has no gen_{nodetype.__name__}')
+
+    # Every program is marked, however it's run, since functions it defines
+    # can be called by later programs run in stackless or async mode (or be
+    # saved in a snapshot, which keeps the marks).
+    def prepare(self, node, max_steps=None, timeout=None, tick_chunk=None):
+        if not super().prepare(node, max_steps, timeout, tick_chunk):
+            return False
+        mark_suspends(node)
+        return True
+
+    # High-level entry point.  Returns a generator that runs the program.
+    # tick_chunk is the number of steps between suspensions.
+    def interpret_steps(self, node, max_steps=None, timeout=None, tick_chunk=1000):
+        try:
+            if self.prepare(node, max_steps, timeout, tick_chunk):
+                yield from self._run_stack(self.gen_Statements(node if isinstance(node, Statements)
+                                                                else Statements([node])))
+        except LoxExit as e:
+            pass
+
+    # Run a program to completion without suspending (stackless mode)
+    def interpret_stackless(self, node, max_steps=None, timeout=None):
+        steps = self.interpret_steps(node, max_steps, timeout, None)
+        error = None
+        while True:
+            try:
+                request = steps.send(None) if error is None else steps.throw(error)
+            except StopIteration:
+                break
+            error = None
+            if request is not None:
+                request.close()
+                error = LoxNativeError('Async natives can only be used in an async run')
+
+    # Trampoline.  When the running generator yields another generator, the
+    # running one is pushed on the stack and the new one is started.  When a
+    # generator finishes, its result (or exception) is passed to the one below
+    # it.  Anything else that's yielded is passed on to the caller.
+    def _run_stack(self, gen):
+        stack = [ ]
+        value = error = None
+        try:
+            while True:
+                try:
+                    if error is None:
+                        request = gen.send(value)
+                    else:
+                        request, error = gen.throw(error), None
+                except StopIteration as e:
+                    if not stack:
+                        return e.value
+                    gen = stack.pop()
+                    value, error = e.value, None
+                    continue
+                except Exception as e:
+                    if not stack:
+                        raise
+                    gen = stack.pop()
+                    error = e
+                    continue
+                if type(request) is types.GeneratorType:
+                    stack.append(gen)
+                    gen = request
+                    value = None
+                else:
+                    try:
+                        value = yield request
+                    except Exception as e:
+                        error = e
+        finally:
+            while stack:
+                stack.pop().close()
+
+    def gen_Statements(self, node):
+        for stmt in node.statements:
+            if stmt.suspends:
+                yield self.gvisit(stmt)
+            else:
+                self.visit(stmt)
+
+    def gen_Print(self, node):
+        value = yield self.gvisit(node.value)
+        self.write(f'{value}\n')
+
+    def gen_ExprStmt(self, node):
+        yield self.gvisit(node.value)
+
+    def gen_VarDeclaration(self, node):
+        self._define(node.binding, (yield self.gvisit(node.initializer)))
+
+    def gen_IfStmt(self, node):
+        test = (yield self.gvisit(node.test)) if node.test.suspends else self.visit(node.test)
+        if _is_truthy(test):
+            branch = node.consequence
+        elif node.alternative:
+            branch = node.alternative
+        else:
+            return
+        if branch.suspends:
+            yield self.gvisit(branch)
+        else:
+            self.visit(branch)
+
+    def gen_WhileStmt(self, node):
+        test, body = node.test, node.body
+        while _is_truthy((yield self.gvisit(test)) if test.suspends else self.visit(test)):
+            if body.suspends:
+                yield self.gvisit(body)
+            else:
+                self.visit(body)
+            self.ticks -= 1
+            if self.ticks < 0:
+                self.check_limits(node)
+                yield
+
+    def gen_Return(self, node):
+        raise ReturnException((yield self.gvisit(node.value)))
+
+    def gen_TailReturn(self, node):
+        raise ReturnException((yield self.gen_Call(node.value, tail=True)))
+
+    # Expressions.  Operands that can't suspend are evaluated directly.
+    def gen_Binary(self, node):
+        left = (yield self.gvisit(node.left)) if node.left.suspends else self.visit(node.left)
+        right = (yield self.gvisit(node.right)) if node.right.suspends else self.visit(node.right)
+        if node.op == '+':
+            return self._add(node, left, right)
+        elif node.op == '==':
+            return left == right
+        elif node.op == '!=':
+            return left != right
+        if type(left) is float and type(right) is float:
+            return _numeric_operators[node.op](left, right)
+        return self._operate(node, left, right)
+
+    def gen_Logical(self, node):
+        left = (yield self.gvisit(node.left)) if node.left.suspends else self.visit(node.left)
+        if _is_truthy(left) == (node.op == 'or'):
+            return left
+        return (yield self.gvisit(node.right)) if node.right.suspends else self.visit(node.right)
+
+    def gen_Unary(self, node):
+        operand = yield self.gvisit(node.operand)
+        if node.op == '-':
+            self._check_numeric_operand(node, operand)
+            return -float(operand)
+        return not _is_truthy(operand)
+
+    def gen_Grouping(self, node):
+        return (yield self.gvisit(node.value))
+
+    def gen_Assign(self, node):
+        value = yield self.gvisit(node.value)
+        self._store(node.binding, value)
+        return value
+
+    def gen_Get(self, node):
+        return self._get(node, (yield self.gvisit(node.object)))
+
+    def gen_Set(self, node):
+        obj = (yield self.gvisit(node.object)) if node.object.suspends else self.visit(node.object)
+        val = (yield self.gvisit(node.value)) if node.value.suspends else self.visit(node.value)
+        return self._set(node, obj, val)
+
+    def gen_Call(self, node, tail=False):
+        callee = (yield self.gvisit(node.func)) if node.func.suspends else self.visit(node.func)
+        self._check_callable(node, callee)
+        args = [ ]
+        for arg in node.arguments:
+            args.append((yield self.gvisit(arg)) if arg.suspends else self.visit(arg))
+        try:
+            if isinstance(callee, LoxFunction):
+                self._check_arity(node, callee, args)
+                if tail:
+                    raise TailCall(callee, args, node)
+                return (yield self._gen_invoke(callee, args, node))
+            elif isinstance(callee, LoxClass):
+                this = callee.new_instance(self)
+                init = callee.find_method('init')
+                if init:
+                    self._check_arity(node, init, args)
+                    yield self._gen_invoke(init.bind(this), args, node)
+                return this
+            elif isinstance(callee, LoxMemoFunction):
+                self._check_arity(node, callee, args)
+                key = (*args, *map(type, args))
+                value = callee.find(key)
+                if value is _missing:
+                    value = callee.store(key, (yield self._gen_invoke(callee.func, args, node)))
+                return value
+            elif isinstance(callee, LoxAsyncNativeFunction):
+                self._check_arity(node, callee, args)
+                try:
+                    return (yield callee.func(*self.native_args(args)))
+                except (LoxNativeError, TimeoutError, LoxMemoryError):
+                    raise
+                except Exception as err:
+                    # Anything else raised by the native is an error in the program
+                    self.error(node.func, failure_message(callee.name, err))
+        except LoxNativeError as err:
+            self.error(node.func, str(err))
+        except TimeoutError:
+            self.error(node, 'Time limit exceeded')
+        except LoxMemoryError as err:
+            self.error(node, str(err))
+        return self._call_values(node, callee, args)
+
+    def _check_arity(self, node, callee, args):
+        if callee.arity is not None and len(args) != callee.arity:
+            self.error(node.func, f'Expected {callee.arity} arguments')
+
+    # Same as LoxFunction.invoke() except that the body is run by gen_*
+    def _gen_invoke(self, func, args, node=None):
+        size = 0
+        oldframe = self.frame
+        oldclosure = self.closure
+        try:
+            while True:
+                self.ticks -= 1
+                if self.ticks < 0:
+                    self.check_limits(node or func.node)
+                    yield
+                frame = [*func.receiver, *args, *func.node.padding]
+                for slot in func.node.cells:
+                    frame[slot] = LoxCell(frame[slot])
+                if self.memory:
+                    self.memory.release(size)
+                    size = loxmemory.FRAME_SIZE + loxmemory.SLOT_SIZE * len(frame)
+                    self.memory.charge(size)
+                self.frame = frame
+                self.closure = func.closure
+                try:
+                    for stmt in func.body:
+                        if stmt.suspends:
+                            yield self.gvisit(stmt)
+                        else:
+                            self.visit(stmt)
+                    return None
+                except ReturnException as e:
+                    return e.value
+                except TailCall as e:
+                    func = e.func
+                    args = e.args
+                    node = e.node
+        finally:
+            self.frame = oldframe
+            self.closure = oldclosure
+            if size:
+                self.memory.release(size)
+
+# Run a program to completion without ever suspending (for testing)
+def _run(source):
+    import io
+    import loxcontext
+    out = io.BytesIO()
+    context = loxcontext.LoxContext(output=out)
+    context.parse(source)
+    for _ in context.interp.interpret_steps(context.ast, tick_chunk=3):
+        pass
+    context.output.flush()
+    return out.getvalue().decode('utf-8')
+
+def test_gen_interpreter():
+    assert _run('''
+fun fib(n) { if (n < 2) return n; return fib(n-2) + fib(n-1); }
+print fib(10);
+var i = 0; while (i < 10) { i = i + 1; } print i;
+class A { init(x) { this.x = x; } get() { return this.x; } }
+class B < A { get() { return super.get() * 2; } }
+print B(fib(5)).get();
+fun counter() { var n = 0; fun inc() { n = n + 1; return n; } return inc; }
+var c = counter(); c(); print c();
+print c() and fib(3) or -c();
+''') == '55.0\n10.0\n10.0\n2.0\n2.0\n'
+
+def test_stackless():
+    import io
+    import loxcontext
+    out = io.BytesIO()
+    context = loxcontext.LoxContext(output=out)
+    context.parse('fun f(n) { if (n == 0) return 0; return 1 + f(n - 1); } print f(100000);')
+    context.run(stackless=True)
+    assert out.getvalue() == b'100000.0\n'
+
+    # Functions defined by an earlier run or restored from a snapshot
+    out = io.BytesIO()
+    context = loxcontext.LoxContext(output=out)
+    context.parse('fun g(n) { return n + 1; }')
+    context.run()
+    snapshot = io.BytesIO()
+    context.snapshot(snapshot)
+    snapshot.seek(0)
+    restored = loxcontext.LoxContext(output=out)
+    restored.restore(snapshot)
+    for ctx in (context, restored):
+        ctx.parse('print g(1);')
+        ctx.run(stackless=True)
+    assert out.getvalue() == b'2.0\n2.0\n'
@@ -2,9 +2,22 @@
 #
 # Tree-walking interpreter
 
-from collections import ChainMap
-from loxast import NodeVisitor
+import collections
+import operator
+import sys
+import time
+
+from loxast import (Node, NodeVisitor, Statement, Statements, Call, FunctionCall, NativeCall,
+                    GenericCall, FloatAdd, StringAdd, GenericAdd, Binary, Unary)
+from loxresolve import LocalBinding, UpvalueBinding
+from loxnative import LoxNativeFunction, LoxNativeError, LoxNativeObject
+from loxarray import LoxArray
+from loxmemory import LoxMemoryError
+import loxarray
+import loxmemory
+import loxnative
 import loxresolve
+import loxspecialize
 
 # Lox truthiness.  See pg. 101. 
 def _is_truthy(value):
@@ -19,6 +32,84 @@ class ReturnException(Exception):
     def __init__(self, value):
         self.value = value
 
+# Raised by a tail call.  Caught by LoxFunction.invoke() which then runs the
+# called function in place of the current one.  node is the Call node (for
+# call hooks).
+class TailCall(Exception):
+    def __init__(self, func, args, node=None):
+        self.func = func
+        self.args = args
+        self.node = node
+
+# Lox string built by concatenation.  Concatenating long strings with + is
+# deferred: the pieces are collected in a list that is joined only when the
+# string's value is needed (printing, comparison, etc.).  The list of parts is
+# shared between a string and the strings made by appending to it.  A string
+# owns the end of the list if count == len(parts) and can append in-place,
+# making repeated appends (e.g., s = s + "x" in a loop) amortized O(1).
+class LoxString:
+    __slots__ = ('parts', 'count', 'length', 'value', '__weakref__')
+
+    def __init__(self, parts, length):
+        self.parts = parts
+        self.count = len(parts)
+        self.length = length
+        self.value = None
+
+    def __str__(self):
+        if self.value is None:
+            self.value = ''.join(self.parts if self.count == len(self.parts) else self.parts[:self.count])
+            # Further appends start from the joined value in a new list
+            self.parts = [ self.value ]
+            self.count = 1
+        return self.value
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if isinstance(other, (str, LoxString)):
+            return str(self) == str(other)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def concat(self, other):
+        other = str(other)
+        if self.count == len(self.parts):
+            parts = self.parts
+        else:
+            parts = self.parts[:self.count]
+        parts.append(other)
+        return LoxString(parts, self.length + len(other))
+
+_string_types = (str, LoxString)
+
+_numeric_operators = {
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    }
+
+# Strings shorter than this are concatenated directly
+_ROPE_MIN_LENGTH = 128
+
+def _concat(left, right):
+    if type(left) is LoxString:
+        return left.concat(right)
+    right = str(right)
+    if len(left) + len(right) < _ROPE_MIN_LENGTH:
+        return left + right
+    return LoxString([left, right], len(left) + len(right))
+
 class LoxExit(BaseException):
     pass
 
@@ -28,33 +119,135 @@ class LoxCallError(Exception):
 class LoxAttributeError(Exception):
     pass
 
+# Storage for a local variable captured by a closure
+class LoxCell:
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+
 class LoxFunction:
-    def __init__(self, node, env):
+    def __init__(self, node, closure, receiver=()):
         self.node = node
-        self.env = env
+        self.closure = closure
+        self.receiver = receiver
+        self.arity = len(node.parameters)
+        self.body = node.statements.statements
 
-    def __call__(self, interp, *args):
-        if len(args) != len(self.node.parameters):
-            raise LoxCallError(f"Expected {len(self.node.parameters)} arguments")
-        newenv = self.env.new_child()
-        for name, arg in zip(self.node.parameters, args):
-            newenv[name] = arg
+    # node is the call, where a step or time limit is reported
+    def __call__(self, interp, *args, node=None):
+        if len(args) != self.arity:
+            raise LoxCallError(f"Expected {self.arity} arguments")
+        return self.invoke(interp, args, node)
 
-        oldenv = interp.env
-        interp.env = newenv
+    # Call with arguments already known to match the arity.  The frame holds
+    # the receiver (for methods), the arguments and then all of the locals of
+    # the function.  Captured parameters are moved into cells.  A tail call
+    # replaces the frame and runs the new function in the same invocation.
+    # Under instrumentation, the call hooks see a tail call as the end of the
+    # function being replaced and a call of the new one.  Exceeding a limit
+    # is reported at node, the call (or the function if there isn't one).
+    def invoke(self, interp, args, node=None):
+        func = self
+        size = 0
+        finish = None
+        result = None
+        oldframe = interp.frame
+        oldclosure = interp.closure
         try:
-            interp.visit(self.node.statements)
-            result = None
-        except ReturnException as e:
-            result = e.value
+            while True:
+                interp.ticks -= 1
+                if interp.ticks < 0:
+                    interp.check_limits(node or func.node)
+                frame = [*func.receiver, *args, *func.node.padding]
+                for slot in func.node.cells:
+                    frame[slot] = LoxCell(frame[slot])
+                if interp.memory:
+                    interp.memory.release(size)
+                    size = loxmemory.FRAME_SIZE + loxmemory.SLOT_SIZE * len(frame)
+                    interp.memory.charge(size)
+                interp.frame = frame
+                interp.closure = func.closure
+                try:
+                    for stmt in func.body:
+                        interp.visit(stmt)
+                    return None
+                except ReturnException as e:
+                    result = e.value
+                    return result
+                except TailCall as e:
+                    func = e.func
+                    args = e.args
+                    node = e.node
+                    if interp._call_hooks:
+                        if finish:
+                            interp._finish_call(finish, None)
+                        finish = interp._start_call(e.node, func)
         finally:
-            interp.env = oldenv
-        return result
+            interp.frame = oldframe
+            interp.closure = oldclosure
+            if size:
+                interp.memory.release(size)
+            if finish:
+                interp._finish_call(finish, result)
 
     def bind(self, instance):
-        env = self.env.new_child()
-        env['this'] = instance
-        return LoxFunction(self.node, env)
+        return LoxFunction(self.node, self.closure, (instance,))
+
+# Memoized function, made by the memoize() native.  Results are cached by
+# argument values in an LRU cache holding at most maxsize results, so the
+# function should be pure.  Arguments are keyed with their types so that
+# true and 1 are different.
+class LoxMemoFunction:
+    def __init__(self, func, maxsize=128):
+        self.func = func
+        self.arity = func.arity
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f'<memoized fn {self.func.node.name}>'
+
+    def __call__(self, interp, *args, node=None):
+        if len(args) != self.arity:
+            raise LoxCallError(f"Expected {self.arity} arguments")
+        key = (*args, *map(type, args))
+        value = self.find(key)
+        if value is _missing:
+            value = self.store(key, self.func.invoke(interp, args, node))
+        return value
+
+    # Cached result for a key (_missing if there isn't one)
+    def find(self, key):
+        value = self.cache.get(key, _missing)
+        if value is _missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return value
+
+    def store(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return value
+
+_missing = object()
+
+# memoize(func) or memoize(func, maxsize).  Used as: fun fib(n) { ... } fib = memoize(fib);
+# Recursive calls go through the global, so they're memoized too.
+@loxnative.native()
+def memoize(func, *maxsize):
+    if len(maxsize) > 1:
+        raise LoxNativeError('Expected 1 or 2 arguments')
+    if not isinstance(func, LoxFunction):
+        raise LoxNativeError('memoize() argument must be a function')
+    size = maxsize[0] if maxsize else 128.0
+    if not loxnative.is_integer(size) or size < 1:
+        raise LoxNativeError('memoize() size must be a positive integer')
+    return LoxMemoFunction(func, int(size))
 
 class LoxClass:
     def __init__(self, name, superclass, methods):
@@ -65,11 +258,18 @@ class LoxClass:
     def __str__(self):
         return self.name
 
-    def __call__(self, *args):
-        this = LoxInstance(self)
+    def __call__(self, interp, *args, node=None):
+        this = self.new_instance(interp)
         init = self.find_method('init')
         if init:
-            init.bind(this)(*args)
+            init.bind(this)(interp, *args, node=node)
+        return this
+
+    # Create an instance without running init()
+    def new_instance(self, interp):
+        this = LoxInstance(self)
+        if interp.memory:
+            this.memsize = interp.memory.track(this, loxmemory.INSTANCE_SIZE)
         return this
 
     def find_method(self, name):
@@ -78,13 +278,21 @@ class LoxClass:
             return self.superclass.find_method(name)
         return meth
 
+# Callables defined in Lox.  Calling them takes the call node.
+_lox_callables = (LoxFunction, LoxMemoFunction, LoxClass)
+
 class LoxInstance:
     def __init__(self, klass):
         self.klass = klass
         self.data = { }
+        self.memsize = None
 
     def __str__(self):
         return self.klass.name + " instance"
+
+    # As for LoxNativeObject
+    def __getstate__(self):
+        return dict(self.__dict__, memsize=None)
     
     def get(self, name):
         if name in self.data:
@@ -100,9 +308,24 @@ class LoxInstance:
 class LoxInterpreter(NodeVisitor):
     def __init__(self, context):
         self.context = context
-        self.env = ChainMap()
-        self.resolve_env = ChainMap()
-        self.localmap = { }
+        self.globals = { }
+        self.frame = [ ]
+        self.closure = ()
+        self.resolve_env = { }
+        self.write = context.output.write
+        self.memory = None
+        self.resolve_time = 0.0
+        self._instrumentation = [ ]
+        self._call_hooks = [ ]
+        self._tracefunc = None
+        self.set_limits()
+        for name, func in loxnative.natives.items():
+            self.define_global(name, func)
+
+    # Predefine a global variable (e.g., a native function)
+    def define_global(self, name, value):
+        self.globals[name] = value
+        self.resolve_env[name] = True
 
     def error(self, position, message):
         self.context.error(position, message)
@@ -120,55 +343,349 @@ class LoxInterpreter(NodeVisitor):
         else:
             self.error(node, f"{node.op} operand must be a number")
         
+    # Execution limits.  Each loop iteration and function call counts as one
+    # step and decrements self.ticks.  When ticks runs out, check_limits()
+    # checks the step budget and the deadline and hands out more ticks.  The
+    # deadline is only checked every tick_chunk steps.  A non-default chunk
+    # makes check_limits() run periodically even without limits (used for
+    # time slicing by loxgeninterp).
+    def set_limits(self, max_steps=None, timeout=None, tick_chunk=None):
+        self.steps_left = max_steps
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.tick_chunk = tick_chunk or 1000
+        if max_steps is None and timeout is None and tick_chunk is None:
+            self.ticks = sys.maxsize
+        else:
+            self.ticks = 0
+
+    def check_limits(self, node):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.error(node, 'Time limit exceeded')
+        if self.steps_left is None:
+            self.ticks = self.tick_chunk
+        elif self.steps_left > 0:
+            self.ticks = min(self.steps_left, self.tick_chunk) - 1
+            self.steps_left -= self.ticks + 1
+        else:
+            self.error(node, 'Step limit exceeded')
+
+    # Instrumentation (profiling, metrics, etc.).  Installs a dispatch table
+    # used by this interpreter only, in which the visitor for each node type
+    # is replaced by wrap(nodetype, method), so the profiler, metrics and
+    # coverage cost nothing when they're not in use.  If call_hook is given, it's called as
+    # call_hook(node, callee) before each call and whatever it returns (if not
+    # None) is called with the value returned when the call finishes (None if
+    # it ended with an error or a tail call).  Instrumentation can be nested.
+    # uninstrument() removes the most recent.
+    def instrument(self, wrap=None, call_hook=None):
+        previous = self.__dict__.get('_visitors')
+        table = { }
+        for nodetype in Node._nodetypes:
+            if previous:
+                method = previous.get(nodetype)
+            elif issubclass(nodetype, Call):
+                method = LoxInterpreter._instrumented_call
+            else:
+                try:
+                    method = self._find_visitor(nodetype)
+                except AttributeError:
+                    method = None
+            if method:
+                table[nodetype] = wrap(nodetype, method) if wrap else method
+        self._instrumentation.append((previous, call_hook))
+        if call_hook:
+            self._call_hooks.append(call_hook)
+        self._visitors = table
+
+    def uninstrument(self):
+        previous, call_hook = self._instrumentation.pop()
+        if call_hook:
+            self._call_hooks.remove(call_hook)
+        if previous:
+            self._visitors = previous
+        else:
+            del self._visitors
+        # A trace hook that was removed while something else was installed
+        # on top of it is taken out now
+        if self._tracefunc is None and self._instrumentation and self._instrumentation[-1][1] == self._trace_call:
+            self.uninstrument()
+
+    def _instrumented_call(self, node):
+        callee = self.visit(node.func)
+        self._check_callable(node, callee)
+        return self._hooked_call(node, callee, [ self.visit(arg) for arg in node.arguments ])
+
+    def _hooked_call(self, node, callee, args):
+        finish = self._start_call(node, callee)
+        value = None
+        try:
+            value = self._call_values(node, callee, args)
+            return value
+        finally:
+            self._finish_call(finish, value)
+
+    def _start_call(self, node, callee):
+        return [ hook(node, callee) for hook in self._call_hooks ]
+
+    def _finish_call(self, finish, value):
+        for func in reversed(finish):
+            if func:
+                func(value)
+
+    # Tracing, like sys.settrace().  hook(event, lineno, arg) is called with
+    # event 'statement' before each statement (arg is the statement node),
+    # 'call' before each call (arg is the callee) and 'return' after a call
+    # returns (arg is the value returned).  lineno is the Lox source line, or
+    # None for statements made up by the parser.  settrace(None) removes the
+    # hook.  The hook is installed with instrument(), so nothing is checked
+    # while it's not set.  Not supported in stackless mode.
+    def settrace(self, hook):
+        tracing = self._tracefunc is not None
+        self._tracefunc = hook
+        if hook is not None and not tracing:
+            self.instrument(self._trace_wrap, self._trace_call)
+        elif hook is None and tracing and self._instrumentation[-1][1] == self._trace_call:
+            self.uninstrument()
+
+    def gettrace(self):
+        return self._tracefunc
+
+    def _trace_wrap(self, nodetype, method):
+        if issubclass(nodetype, Statement) and not issubclass(nodetype, Statements):
+            def visit_statement(interp, node):
+                if interp._tracefunc:
+                    interp._tracefunc('statement', interp._lineno(node), node)
+                return method(interp, node)
+            return visit_statement
+        return method
+
+    def _trace_call(self, node, callee):
+        if self._tracefunc:
+            lineno = self._lineno(node)
+            self._tracefunc('call', lineno, callee)
+            def trace_return(value):
+                if self._tracefunc:
+                    self._tracefunc('return', lineno, value)
+            return trace_return
+
+    def _lineno(self, node):
+        try:
+            return self.context.parser.line_position(node)
+        except KeyError:
+            return None
+
     # High-level entry point
-    def interpret(self, node):
+    def interpret(self, node, max_steps=None, timeout=None):
         try:
-            loxresolve.resolve(node, self.resolve_env, self)
-            if not self.context.have_errors:
-                self.visit(node)
+            if self.prepare(node, max_steps, timeout):
+                self.execute(node)
         except LoxExit as e:
             pass
-        
+
+    # Run a program that has been prepared
+    def execute(self, node):
+        for stmt in (node.statements if isinstance(node, Statements) else [node]):
+            self.visit(stmt)
+
+    # Resolve a program and set up the interpreter state for running it.
+    # Returns False if there were errors.  The time taken is left in
+    # self.resolve_time.
+    def prepare(self, node, max_steps=None, timeout=None, tick_chunk=None):
+        start = time.perf_counter()
+        nslots = loxresolve.resolve(node, self.resolve_env, self.context)
+        if not self.context.have_errors:
+            loxspecialize.specialize(node)
+        self.resolve_time = time.perf_counter() - start
+        if self.context.have_errors:
+            return False
+        self.frame = [None] * nslots
+        self.closure = ()
+        self.write = self.context.output.write
+        self.set_limits(max_steps, timeout, tick_chunk)
+        return True
+
+    # Variable access by binding.  Used for declarations and the less common
+    # references.  Variable/Assign are specialized by loxspecialize instead.
+    def _load(self, binding):
+        if type(binding) is LocalBinding:
+            value = self.frame[binding.slot]
+            return value.value if binding.captured else value
+        elif type(binding) is UpvalueBinding:
+            return self.closure[binding.index].value
+        else:
+            return self.globals[binding.name]
+
+    def _store(self, binding, value):
+        if type(binding) is LocalBinding:
+            if binding.captured:
+                self.frame[binding.slot].value = value
+            else:
+                self.frame[binding.slot] = value
+        elif type(binding) is UpvalueBinding:
+            self.closure[binding.index].value = value
+        else:
+            self.globals[binding.name] = value
+
+    # Create a new variable.  A captured local gets a fresh cell each time its
+    # declaration executes (e.g., on each iteration of a loop).
+    def _define(self, binding, value):
+        if type(binding) is LocalBinding:
+            self.frame[binding.slot] = LoxCell(value) if binding.captured else value
+        else:
+            self.globals[binding.name] = value
+
+    def _make_function(self, node):
+        closure = [ self.frame[index] if is_local else self.closure[index]
+                    for is_local, index in node.upvalues ]
+        func = LoxFunction(node, closure)
+        if self.memory:
+            self._track(node, func, loxmemory.FUNCTION_SIZE + loxmemory.UPVALUE_SIZE * len(closure))
+        return func
+
+    # Memory accounting (if enabled)
+    def _track(self, node, obj, nbytes):
+        try:
+            return self.memory.track(obj, nbytes)
+        except LoxMemoryError as err:
+            self.error(node, str(err))
+
+    def _concat(self, node, left, right):
+        result = _concat(left, right)
+        if self.memory and type(result) is LoxString:
+            self._track(node, result, loxmemory.STRING_SIZE + result.length)
+        return result
+
+    # Blocks don't create a scope at runtime.  The resolver assigned their
+    # locals to slots in the enclosing frame.
     def visit_Statements(self, node):
-        self.env = self.env.new_child()
         for stmt in node.statements:
             self.visit(stmt)
-        self.env = self.env.parents
 
     def visit_Literal(self, node):
         return node.value
 
+    # Binary operators.  Each Binary node is specialized to the class for its
+    # operator by loxspecialize.  Float operands are checked first since
+    # they're by far the most common.  Anything else falls back to the slower
+    # checks and error reporting.  A node that wasn't specialized (e.g., one
+    # made up after the pass) is specialized when it's first run.
     def visit_Binary(self, node):
+        if type(node) is not Binary or not loxspecialize.specialize_operator(node):
+            raise NotImplementedError(f"Bad operator {node.op}")
+        return self.visit(node)
+
+    # '+' is quickened to a float or string version on first use
+    def visit_Add(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
+            node.become(FloatAdd)
+        elif isinstance(left, _string_types) and isinstance(right, _string_types):
+            node.become(StringAdd)
+        else:
+            node.become(GenericAdd)
+        return self._add(node, left, right)
+
+    def visit_FloatAdd(self, node):
         left = self.visit(node.left)
         right = self.visit(node.right)
-        if node.op == '+':
-            (isinstance(left, str) and isinstance(right, str)) or self._check_numeric_operands(node, left, right)
+        if type(left) is float and type(right) is float:
             return left + right
-        elif node.op == '-':
-            self._check_numeric_operands(node, left, right)
+        node.become(GenericAdd)
+        return self._add(node, left, right)
+
+    def visit_StringAdd(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if isinstance(left, _string_types) and isinstance(right, _string_types):
+            return self._concat(node, left, right)
+        node.become(GenericAdd)
+        return self._add(node, left, right)
+
+    def visit_GenericAdd(self, node):
+        return self._add(node, self.visit(node.left), self.visit(node.right))
+
+    def _add(self, node, left, right):
+        if isinstance(left, _string_types) and isinstance(right, _string_types):
+            return self._concat(node, left, right)
+        if isinstance(left, LoxArray) or isinstance(right, LoxArray):
+            return self._operate(node, left, right)
+        self._check_numeric_operands(node, left, right)
+        return float(left) + float(right)
+
+    # Arithmetic and comparisons on operands that aren't both floats.  Arrays
+    # (see loxarray) are operated on elementwise.  Other numbers are float
+    # subclasses (e.g., numpy.float64 returned by a native) and are converted
+    # to float.  Anything else is an error.
+    def _operate(self, node, left, right):
+        if isinstance(left, LoxArray) or isinstance(right, LoxArray):
+            try:
+                result = loxarray.operate(node.op, left, right)
+            except LoxNativeError as err:
+                self.error(node, str(err))
+            if self.memory:
+                try:
+                    result.charge(self.memory, len(result))
+                except LoxMemoryError as err:
+                    self.error(node, str(err))
+            return result
+        self._check_numeric_operands(node, left, right)
+        return _numeric_operators[node.op](float(left), float(right))
+
+    def visit_Subtract(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left - right
-        elif node.op == '*':
-            self._check_numeric_operands(node, left, right)            
+        return self._operate(node, left, right)
+
+    def visit_Multiply(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left * right
-        elif node.op == '/':
-            self._check_numeric_operands(node, left, right)            
+        return self._operate(node, left, right)
+
+    def visit_Divide(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left / right
-        elif node.op == '==':
-            return left == right
-        elif node.op == '<':
-            self._check_numeric_operands(node, left, right)            
+        return self._operate(node, left, right)
+
+    def visit_Less(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left < right
-        elif node.op == '>':
-            self._check_numeric_operands(node, left, right)            
-            return left > right
-        elif node.op == '<=':
-            self._check_numeric_operands(node, left, right)            
+        return self._operate(node, left, right)
+
+    def visit_LessEqual(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left <= right
-        elif node.op == '>=':
-            self._check_numeric_operands(node, left, right)            
+        return self._operate(node, left, right)
+
+    def visit_Greater(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
+            return left > right
+        return self._operate(node, left, right)
+
+    def visit_GreaterEqual(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        if type(left) is float and type(right) is float:
             return left >= right
-        else:
-            raise NotImplementedError(f"Bad operator {node.op}")
+        return self._operate(node, left, right)
+
+    def visit_Equal(self, node):
+        return self.visit(node.left) == self.visit(node.right)
+
+    def visit_NotEqual(self, node):
+        return self.visit(node.left) != self.visit(node.right)
 
     def visit_Logical(self, node):
         left = self.visit(node.left)
@@ -179,34 +696,103 @@ class LoxInterpreter(NodeVisitor):
         raise NotImplementedError(f"Bad operator {node.op}")
         
     def visit_Unary(self, node):
+        if type(node) is not Unary or not loxspecialize.specialize_operator(node):
+            raise NotImplementedError(f"Bad operator {node.op}")
+        return self.visit(node)
+
+    def visit_Negate(self, node):
         operand = self.visit(node.operand)
-        if node.op == "-":
-            self._check_numeric_operand(node, operand)
+        if type(operand) is float:
             return -operand
-        elif node.op == "!":
-            return not _is_truthy(operand)
-        else:
-            raise NotImplementedError(f"Bad operator {node.op}")
+        self._check_numeric_operand(node, operand)
+        return -float(operand)
+
+    def visit_Not(self, node):
+        return not _is_truthy(self.visit(node.operand))
 
     def visit_Grouping(self, node):
         return self.visit(node.value)
 
     def visit_Variable(self, node):
-        return self.env.maps[self.localmap[id(node)]][node.name]
-        
+        return self._load(node.binding)
+
+    def visit_LocalVariable(self, node):
+        return self.frame[node.slot]
+
+    def visit_CellVariable(self, node):
+        return self.frame[node.slot].value
+
+    def visit_UpvalueVariable(self, node):
+        return self.closure[node.slot].value
+
+    def visit_GlobalVariable(self, node):
+        return self.globals[node.name]
+
+    # Calls are quickened to a direct call if the first call is to a
+    # LoxFunction or a native function with the right number of arguments.
+    # Native functions are called without the interpreter or any frame setup.
     def visit_Call(self, node):
         callee = self.visit(node.func)
+        if isinstance(callee, LoxFunction) and callee.arity == len(node.arguments):
+            node.become(FunctionCall)
+        elif type(callee) is LoxNativeFunction and callee.arity in (None, len(node.arguments)):
+            node.become(NativeCall)
+        else:
+            node.become(GenericCall)
+        return self._call(node, callee)
+
+    def visit_FunctionCall(self, node):
+        callee = self.visit(node.func)
+        if type(callee) is LoxFunction and callee.arity == len(node.arguments):
+            try:
+                return callee.invoke(self, [ self.visit(arg) for arg in node.arguments ], node)
+            except LoxMemoryError as err:
+                self.error(node, str(err))
+        node.become(GenericCall)
+        return self._call(node, callee)
+
+    def visit_NativeCall(self, node):
+        callee = self.visit(node.func)
+        if type(callee) is LoxNativeFunction and callee.arity in (None, len(node.arguments)):
+            try:
+                return callee.func(*self.native_args([ self.visit(arg) for arg in node.arguments ]))
+            except LoxNativeError as err:
+                self.error(node.func, str(err))
+            except LoxMemoryError as err:
+                self.error(node, str(err))
+            except Exception as err:
+                self.error(node.func, loxnative.failure_message(callee.name, err))
+        node.become(GenericCall)
+        return self._call(node, callee)
+
+    def visit_GenericCall(self, node):
+        return self._call(node, self.visit(node.func))
+
+    # Arguments for a Python native.  Concatenated strings are flattened, so
+    # natives only ever see str.
+    def native_args(self, args):
+        return [ str(arg) if type(arg) is LoxString else arg for arg in args ]
+
+    def _call(self, node, callee):
+        self._check_callable(node, callee)
+        return self._call_values(node, callee, [ self.visit(arg) for arg in node.arguments ])
+
+    def _check_callable(self, node, callee):
         if not callable(callee):
             self.error(node.func, f'{self.context.find_source(node.func)!r} is not callable')
-        
-        args = [ self.visit(arg) for arg in node.arguments ]
+
+    def _call_values(self, node, callee, args):
         try:
+            if isinstance(callee, _lox_callables):
+                return callee(self, *args, node=node)
             return callee(self, *args)
-        except LoxCallError as err:
+        except (LoxCallError, LoxNativeError) as err:
             self.error(node.func, str(err))
+        except LoxMemoryError as err:
+            self.error(node, str(err))
         
     def visit_Print(self, node):
-        print(self.visit(node.value))
+        self.write(f'{self.visit(node.value)}\n')
 
     def visit_ExprStmt(self, node):
         self.visit(node.value)
@@ -216,16 +802,33 @@ class LoxInterpreter(NodeVisitor):
             initializer = self.visit(node.initializer)
         else:
             initializer = None
-        self.env[node.name] = initializer
+        self._define(node.binding, initializer)
 
     def visit_FuncDeclaration(self, node):
-        func = LoxFunction(node, self.env)
-        self.env[node.name] = func
-        
+        self._define(node.binding, None)
+        self._store(node.binding, self._make_function(node))
+
     def visit_Assign(self, node):
         value = self.visit(node.value)
-        self.env.maps[self.localmap[id(node)]][node.name] = value
-        
+        self._store(node.binding, value)
+        return value
+
+    def visit_LocalAssign(self, node):
+        value = self.frame[node.slot] = self.visit(node.value)
+        return value
+
+    def visit_CellAssign(self, node):
+        value = self.frame[node.slot].value = self.visit(node.value)
+        return value
+
+    def visit_UpvalueAssign(self, node):
+        value = self.closure[node.slot].value = self.visit(node.value)
+        return value
+
+    def visit_GlobalAssign(self, node):
+        value = self.globals[node.name] = self.visit(node.value)
+        return value
+
     def visit_IfStmt(self, node):
         test = self.visit(node.test)
         if _is_truthy(test):
@@ -236,51 +839,252 @@ class LoxInterpreter(NodeVisitor):
     def visit_WhileStmt(self, node):
         while _is_truthy(self.visit(node.test)):
             self.visit(node.body)
+            self.ticks -= 1
+            if self.ticks < 0:
+                self.check_limits(node)
 
     def visit_Return(self, node):
         raise ReturnException(self.visit(node.value))
 
+    def visit_TailReturn(self, node):
+        call = node.value
+        callee = self.visit(call.func)
+        if type(callee) is LoxFunction and callee.arity == len(call.arguments):
+            raise TailCall(callee, [ self.visit(arg) for arg in call.arguments ], call)
+        if self._call_hooks:
+            self._check_callable(call, callee)
+            raise ReturnException(self._hooked_call(call, callee, [ self.visit(arg) for arg in call.arguments ]))
+        raise ReturnException(self._call(call, callee))
+
     def visit_ClassDeclaration(self, node):
+        self._define(node.binding, None)
         if node.superclass:
             superclass = self.visit(node.superclass)
-            env = self.env.new_child()
-            env['super'] = superclass
+            self._define(node.super_binding, superclass)
         else:
             superclass = None
-            env = self.env
         methods = { }
         for meth in node.methods:
-            methods[meth.name] = LoxFunction(meth, env)
+            methods[meth.name] = self._make_function(meth)
         cls = LoxClass(node.name, superclass, methods)
-        self.env[node.name] = cls
+        self._store(node.binding, cls)
         
     def visit_Get(self, node):
-        obj = self.visit(node.object)
+        return self._get(node, self.visit(node.object))
+
+    def _get(self, node, obj):
         if isinstance(obj, LoxInstance):
             try:
                 return obj.get(node.name)
             except LoxAttributeError as err:
                 self.error(node.object, str(err))
+        elif isinstance(obj, LoxNativeObject):
+            try:
+                return obj.lox_get(node.name)
+            except LoxNativeError as err:
+                self.error(node.object, str(err))
         else:
             self.error(node.object, f'{self.context.find_source(node.object)!r} is not an instance')
 
     def visit_Set(self, node):
-        obj = self.visit(node.object)
-        val = self.visit(node.value)
+        return self._set(node, self.visit(node.object), self.visit(node.value))
+
+    def _set(self, node, obj, val):
         if isinstance(obj, LoxInstance):
+            if obj.memsize and node.name not in obj.data:
+                try:
+                    self.memory.grow(obj.memsize, loxmemory.FIELD_SIZE)
+                except LoxMemoryError as err:
+                    self.error(node, str(err))
             obj.set(node.name, val)
             return val
         else:
             self.error(node.object, f'{self.context.find_source(node.object)!r} is not an instance')
 
     def visit_This(self, node):
-        return self.env.maps[self.localmap[id(node)]]['this']
+        return self._load(node.binding)
 
     def visit_Super(self, node):
-        distance = self.localmap[id(node)]
-        superclass = self.env.maps[distance]['super']
-        this = self.env.maps[distance-1]['this']
+        superclass = self._load(node.super_binding)
+        this = self._load(node.this_binding)
         method = superclass.find_method(node.name)
         if not method:
-            self.error(node.object, f'Undefined property {node.name!r}')
+            self.error(node, f'Undefined property {node.name!r}')
         return method.bind(this)
+
+def test_tail_calls():
+    import io
+    import loxcontext
+    source = '''
+fun loop(n) { if (n > 0) return loop(n - 1); return "done"; }
+print loop(100000);
+class A { count(k) { if (k == 0) return this; return this.count(k - 1); } }
+print A().count(100000);
+'''
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.parse(source)
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'done\nA instance\n'
+
+    # Instrumentation doesn't turn tail calls into ordinary calls
+    out = io.BytesIO()
+    context = loxcontext.LoxContext(output=out, metrics=True)
+    context.parse(source)
+    context.run(profile=True, coverage=True)
+    assert out.getvalue() == b'done\nA instance\n'
+    assert context.metrics['calls'] == 200003
+    assert context.profiler.functions[('<string>', 2, 'loop')].calls == 100001
+
+def test_settrace():
+    import asyncio
+    import io
+    import loxcontext
+    context = loxcontext.LoxContext(output=io.BytesIO())
+    context.parse('''fun add(a, b) {
+  return a + b;
+}
+var x = add(1, 2);
+print x;
+''')
+    events = [ ]
+    interp = context.interp
+    interp.settrace(lambda event, lineno, arg: events.append((event, lineno)))
+    assert interp.gettrace() is not None
+    context.run()
+    assert events == [('statement', 1), ('statement', 4), ('call', 4), ('statement', 2),
+                      ('return', 4), ('statement', 5)]
+    # The suspendable interpreter doesn't go through the hooks
+    for run in (lambda: context.run(stackless=True), lambda: asyncio.run(context.run_async())):
+        try:
+            run()
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+    # Removing the hook under other instrumentation
+    interp.instrument()
+    interp.settrace(None)
+    assert '_visitors' in interp.__dict__
+    interp.uninstrument()
+    assert '_visitors' not in interp.__dict__ and not interp._instrumentation
+
+def test_memoize():
+    import io
+    import loxcontext
+    source = '''
+fun fib(n) { if (n < 2) return n; return fib(n - 2) + fib(n - 1); }
+fib = memoize(fib);
+print fib(60);
+fun square(x) { return x * x; }
+var sq = memoize(square, 2);
+sq(1); sq(2); sq(1); sq(3); sq(2);
+'''
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.parse(source)
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'1548008755920.0\n'
+        fib = context.interp.globals['fib']
+        assert (fib.hits, fib.misses) == (58, 61)
+        sq = context.interp.globals['sq']
+        assert (sq.hits, sq.misses) == (1, 4) and len(sq.cache) == 2
+
+    for source, message in [('memoize(clock);', 'memoize() argument must be a function'),
+                            ('fun f() { } memoize(f, (1 / Array(1)).get(0));', 'memoize() size must be a positive integer')]:
+        assert loxcontext._diagnose(source) == [(1, message)]
+
+def test_limits():
+    import io
+    import loxcontext
+    for stackless in (False, True):
+        for limits, message in [({'max_steps': 1000}, 'Step limit exceeded'),
+                                ({'timeout': 0.01}, 'Time limit exceeded')]:
+            errors = io.StringIO()
+            context = loxcontext.LoxContext(output=io.BytesIO(), errors=errors)
+            context.parse('\nfor (var i = 0; i < 100000000; i = i + 1) { }')
+            context.run(stackless=stackless, **limits)
+            assert context.diagnostics == [(2, message)]
+            assert 'for (var i = 0;' in errors.getvalue()
+
+    # A limit reached by a call is reported at the call, not the function
+    source = 'fun f() {\n  return 1;\n}\nclass A { init() { } }\nwhile (true) { f(); A(); }'
+    for stackless in (False, True):
+        for max_steps in (999, 1000, 1001):
+            errors = io.StringIO()
+            context = loxcontext.LoxContext(output=io.BytesIO(), errors=errors)
+            context.parse(source)
+            context.run(stackless=stackless, max_steps=max_steps)
+            assert context.diagnostics == [(5, 'Step limit exceeded')]
+            assert 'return 1' not in errors.getvalue()
+
+def test_float_subclasses():
+    import io
+    import loxcontext
+    class Float(float):
+        pass
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.define_native('two', lambda: Float(2.0), 0)
+        context.parse('print two() < 3; print two() >= 3; print -(two()); print two() * 2; print two() + 1; '
+                      'if (two() > 1) print "yes";')
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'True\nFalse\n-2.0\n4.0\n3.0\nyes\n'
+
+def test_quickening():
+    import io
+    import loxast
+    import loxcontext
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out, errors=io.StringIO())
+        context.parse('fun add(a, b) { return a + b; } print add(1, 2);')
+        context.run(stackless=stackless)
+        [node] = [ n for n in loxast.walk(context.ast) if getattr(n, 'op', None) == '+' ]
+        assert type(node) is loxast.FloatAdd
+
+        # A site that sees other operands falls back to the generic version
+        context.parse('print add("a", "b"); print add(3, 4); add(1, nil);')
+        context.run(stackless=stackless)
+        assert type(node) is loxast.GenericAdd
+        assert out.getvalue() == b'3.0\nab\n7.0\n'
+        assert context.diagnostics == [(1, '+ operands must be numbers')]
+
+def test_escape_analysis():
+    import io
+    import loxcontext
+    for stackless in (False, True):
+        frames = [ ]
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.define_native('frame', lambda: frames.append(list(context.interp.frame)))
+        context.parse('fun f(a, b) { var c = 3; var d = 4; fun g() { return b + d; } frame(); return g; } print f(1, 2)();')
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'6.0\n'
+        # Only b and d are captured, so only they are in cells
+        [[a, b, c, d, g]] = frames
+        assert (a, c) == (1.0, 3.0) and type(g) is LoxFunction
+        assert type(b) is LoxCell and type(d) is LoxCell and (b.value, d.value) == (2.0, 4.0)
+
+def test_loop_closures():
+    import io
+    import loxcontext
+    # A local declared in a loop body gets a fresh cell each iteration even
+    # though it has a single slot in the function's frame
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.parse('fun h() { var gs = List(); for (var i = 0; i < 3; i = i + 1) { var j = i; fun g() { return j; } '
+                      'gs.append(g); } print gs.get(0)() + gs.get(1)() * 10 + gs.get(2)() * 100; } h();')
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'210.0\n'
+
+def test_unspecialized_operators():
+    import loxast
+    import loxcontext
+    interp = loxcontext.LoxContext().interp
+    node = Binary(Unary('-', loxast.Literal(2.0)), '*', Binary(loxast.Literal(3.0), '+', loxast.Literal(4.0)))
+    assert interp.visit(node) == -14.0
+    assert type(node) is loxast.Multiply and type(node.left) is loxast.Negate
@@ -0,0 +1,81 @@
+# loxmemory.py
+#
+# Approximate memory accounting for Lox programs.  When enabled, the
+# interpreter charges an estimated size for each instance, closure, long
+# string, array, collection and call frame it creates.  Frames are released
+# when the call returns.  Everything else is released when Python frees the
+# object (via weakref.finalize).  The live total can be capped with a quota.
+
+import weakref
+
+# Estimated sizes in bytes (CPython, 64-bit)
+INSTANCE_SIZE = 120
+FIELD_SIZE = 32
+FUNCTION_SIZE = 160
+UPVALUE_SIZE = 56          # Reference in the closure plus the captured cell
+FRAME_SIZE = 56
+SLOT_SIZE = 8
+STRING_SIZE = 48           # Plus one per character
+ARRAY_SIZE = 112           # Plus ELEMENT_SIZE per element
+ELEMENT_SIZE = 8
+LIST_SIZE = 56             # Plus ELEMENT_SIZE per element
+MAP_SIZE = 64              # Plus ENTRY_SIZE per entry
+ENTRY_SIZE = 48
+
+class LoxMemoryError(Exception):
+    pass
+
+class LoxMemory:
+    def __init__(self, quota=None):
+        self.quota = quota
+        self.live = 0
+        self.peak = 0
+        self.allocated = 0
+
+    def charge(self, nbytes):
+        self.live += nbytes
+        self.allocated += nbytes
+        if self.live > self.peak:
+            self.peak = self.live
+        if self.quota is not None and self.live > self.quota:
+            raise LoxMemoryError(f'Memory quota of {self.quota} bytes exceeded')
+
+    def release(self, nbytes):
+        self.live -= nbytes
+
+    # Charge for an object and release the charge when it is freed.  Returns a
+    # one-element list holding the object's current size so that it can grow.
+    def track(self, obj, nbytes):
+        size = [ 0 ]
+        weakref.finalize(obj, self._release_size, size)
+        self.grow(size, nbytes)
+        return size
+
+    def grow(self, size, nbytes):
+        size[0] += nbytes
+        self.charge(nbytes)
+
+    def _release_size(self, size):
+        self.live -= size[0]
+
+def test_memory():
+    class Obj:
+        pass
+    memory = LoxMemory(quota=1000)
+    obj = Obj()
+    size = memory.track(obj, 100)
+    memory.grow(size, 50)
+    memory.charge(200)
+    assert memory.live == 350
+    del obj
+    assert memory.live == 200
+    memory.release(200)
+    assert memory.live == 0 and memory.peak == 350
+    try:
+        memory.charge(2000)
+        assert False
+    except LoxMemoryError:
+        pass
+
+if __name__ == '__main__':
+    test_memory()
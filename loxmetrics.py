@@ -0,0 +1,97 @@
+# loxmetrics.py
+#
+# Execution counters for LoxContext metrics.
+#
+# The metrics themselves are in LoxContext.metrics, a dict filled in by
+# parse() and run():
+#
+#     tokens          number of tokens
+#     lex_time        seconds spent tokenizing
+#     parse_time      seconds spent parsing (including the optimizer)
+#     resolve_time    seconds spent in resolution and specialization
+#     exec_time       seconds spent running the program
+#
+# and, with LoxContext(metrics=True):
+#
+#     reductions      parser reductions
+#     nodes           AST nodes
+#     statements      statements executed
+#     calls           calls made
+#     instances       instances created
+#     frames          call frames created
+#     cells           cells created for captured variables
+#
+# The execution counters aren't collected in stackless mode, and
+# run_async() doesn't record run metrics.
+
+from loxast import Statement, Statements, Declaration
+from loxinterp import LoxFunction, LoxClass
+from loxresolve import LocalBinding
+
+class LoxCounters:
+    def __init__(self):
+        self.statements = 0
+        self.calls = 0
+        self.instances = 0
+        self.frames = 0
+        self.cells = 0
+
+    def install(self, interp):
+        interp.instrument(self._wrap, self._call_hook)
+
+    def uninstall(self, interp):
+        interp.uninstrument()
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    def _wrap(self, nodetype, method):
+        if issubclass(nodetype, Declaration):
+            def visit_declaration(interp, node):
+                self.statements += 1
+                for binding in (getattr(node, 'binding', None), getattr(node, 'super_binding', None)):
+                    if isinstance(binding, LocalBinding) and binding.captured:
+                        self.cells += 1
+                return method(interp, node)
+            return visit_declaration
+        elif issubclass(nodetype, Statement) and not issubclass(nodetype, Statements):
+            def visit_statement(interp, node):
+                self.statements += 1
+                return method(interp, node)
+            return visit_statement
+        return method
+
+    def _call_hook(self, node, callee):
+        self.calls += 1
+        if isinstance(callee, LoxClass):
+            self.instances += 1
+            callee = callee.find_method('init')
+        if isinstance(callee, LoxFunction):
+            self.frames += 1
+            self.cells += len(callee.node.cells)
+
+def test_metrics():
+    import io
+    import loxcontext
+    pushed = [ ]
+    context = loxcontext.LoxContext(output=io.BytesIO(), metrics=True,
+                                    metrics_hook=lambda event, metrics: pushed.append((event, dict(metrics))))
+    context.parse('''
+class Point { init(x) { this.x = x; } }
+fun make(n) {
+  var count = 0;
+  fun inc() { count = count + 1; }
+  for (var i = 0; i < n; i = i + 1) { Point(i); inc(); }
+  return count;
+}
+print make(3);
+''')
+    assert [ event for event, _ in pushed ] == ['parse']
+    metrics = context.metrics
+    assert metrics['tokens'] == 77 and metrics['reductions'] > metrics['nodes'] > 0
+    context.run()
+    assert [ event for event, _ in pushed ] == ['parse', 'run']
+    assert metrics['calls'] == 7 and metrics['instances'] == 3
+    assert metrics['frames'] == 7 and metrics['cells'] == 1
+    assert metrics['statements'] > 20
+    assert all(metrics[name] >= 0 for name in ('lex_time', 'parse_time', 'resolve_time', 'exec_time'))
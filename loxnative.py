@@ -0,0 +1,190 @@
+# loxnative.py
+#
+# Native functions.  These are Python functions callable from Lox.  They are
+# predefined as globals in every interpreter.  Additional natives can be
+# registered globally with the @native decorator or for a single context
+# using LoxContext.define_native().
+
+import inspect
+import time
+
+from loxmemory import LoxMemoryError
+
+class LoxNativeError(Exception):
+    pass
+
+# Message for an exception raised by a native that isn't a Lox error (e.g., a
+# ValueError from a Python function used as a native)
+def failure_message(name, err):
+    return f'{name}() failed: {type(err).__name__}: {err}'
+
+class LoxNativeFunction:
+    def __init__(self, name, func, arity=None):
+        self.name = name
+        self.func = func
+        self.arity = arity if arity is not None else _arity(func)
+
+    def __str__(self):
+        return f'<native fn {self.name}>'
+
+    # Generic calling convention (with arity checking).  The interpreter
+    # quickens call sites to call self.func directly.
+    def __call__(self, interp, *args):
+        if self.arity is not None and len(args) != self.arity:
+            raise LoxNativeError(f"Expected {self.arity} arguments")
+        try:
+            return self.func(*interp.native_args(args))
+        except (LoxNativeError, LoxMemoryError):
+            raise
+        except Exception as err:
+            raise LoxNativeError(failure_message(self.name, err))
+
+# Native defined by an async def function.  These can only be called from a
+# program run by loxasync, which awaits the result while other programs run.
+class LoxAsyncNativeFunction(LoxNativeFunction):
+    def __call__(self, interp, *args):
+        raise LoxNativeError(f'{self.name}() can only be used in an async run')
+
+# Native that is also passed the interpreter, as its first argument (e.g., to
+# charge what it makes to memory accounting)
+class LoxInterpNativeFunction(LoxNativeFunction):
+    def __call__(self, interp, *args):
+        if self.arity is not None and len(args) != self.arity:
+            raise LoxNativeError(f"Expected {self.arity} arguments")
+        try:
+            return self.func(interp, *interp.native_args(args))
+        except (LoxNativeError, LoxMemoryError):
+            raise
+        except Exception as err:
+            raise LoxNativeError(failure_message(self.name, err))
+
+# Native object.  Lox code can call the methods named in lox_methods using
+# method syntax (obj.name(args)).  Getting one makes a native function bound
+# to the object.
+class LoxNativeObject:
+    lox_methods = ()
+
+    # Memory accounting: the object's own size and the size of each element
+    base_size = 0
+    item_size = 0
+    memory = None
+    memsize = None
+
+    @classmethod
+    def __init_subclass__(cls):
+        # Arities not counting self
+        cls._lox_arities = { }
+        for name in cls.lox_methods:
+            arity = _arity(getattr(cls, name))
+            cls._lox_arities[name] = arity - 1 if arity is not None else None
+
+    def lox_get(self, name):
+        if name not in self._lox_arities:
+            raise LoxNativeError(f'Undefined property {name!r}')
+        return LoxNativeFunction(name, getattr(self, name), self._lox_arities[name])
+
+    # Memory accounting doesn't carry over into a restored snapshot
+    def __getstate__(self):
+        return dict(self.__dict__, memory=None, memsize=None)
+
+    # Charge the object (holding count elements) to memory accounting.
+    # Raises LoxMemoryError if the quota is exceeded.
+    def charge(self, memory, count):
+        self.memory = memory
+        self.memsize = memory.track(self, self.base_size + self.item_size * count)
+        return self
+
+    # Adjust the charge for elements added (or removed, if count < 0)
+    def grow(self, count):
+        if not self.memory:
+            return
+        if count > 0:
+            self.memory.grow(self.memsize, self.item_size * count)
+        else:
+            self.memsize[0] += self.item_size * count
+            self.memory.release(-self.item_size * count)
+
+# Make a native function of the appropriate kind
+def new_native(name, func, arity=None, interp=False):
+    if interp:
+        if arity is None and _arity(func) is not None:
+            arity = _arity(func) - 1
+        return LoxInterpNativeFunction(name, func, arity)
+    if inspect.iscoroutinefunction(func):
+        return LoxAsyncNativeFunction(name, func, arity)
+    return LoxNativeFunction(name, func, arity)
+
+# Whether a value is a number with an integer value.  inf and nan aren't, so
+# int() can be used on it safely.
+def is_integer(value):
+    return type(value) is float and value.is_integer()
+
+# Number of arguments a Python function must be called with.  None if that
+# varies (optional or variable positional arguments) or can't be found out
+# (e.g., some builtins have no signature).
+def _arity(func):
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    positional = [ p for p in params if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD, p.VAR_POSITIONAL) ]
+    if any(p.kind == p.VAR_POSITIONAL or p.default is not p.empty for p in positional):
+        return None
+    return len(positional)
+
+# Registry of natives defined in every interpreter
+natives = { }
+
+def native(name=None, arity=None, interp=False):
+    def decorate(func):
+        fname = name or func.__name__
+        natives[fname] = new_native(fname, func, arity, interp)
+        return func
+    return decorate
+
+@native()
+def clock():
+    return time.perf_counter()
+
+@native()
+async def sleep(seconds):
+    import asyncio
+    if type(seconds) is not float or seconds < 0:
+        raise LoxNativeError('sleep() argument must be a non-negative number')
+    await asyncio.sleep(seconds)
+
+def test_natives():
+    import io, contextlib
+    import loxcontext
+    context = loxcontext.LoxContext()
+    context.define_native('double', lambda x: 2 * x)
+    context.parse('var t = clock(); print clock() >= t; print double(21);')
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        context.run()
+    assert out.getvalue() == 'True\n42.0\n'
+
+    # Natives get Python strings, even for long strings made by concatenation
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out)
+        context.define_native('kind', lambda x: type(x).__name__)
+        context.parse('var s = "x"; for (var i = 0; i < 8; i = i + 1) s = s + s; '
+                      'print kind(s); var k = kind; print k(s + s);')
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'str\nstr\n'
+
+    # Optional arguments, builtins without a signature and Python exceptions
+    for stackless in (False, True):
+        out = io.BytesIO()
+        context = loxcontext.LoxContext(output=out, errors=io.StringIO())
+        context.define_native('add', lambda x, y=1.0: x + y)
+        context.define_native('mx', max)
+        context.define_native('num', float)
+        context.parse('print add(1); print add(1, 2); print mx(1, 3, 2); var n = num; print n("2"); num("abc");')
+        context.run(stackless=stackless)
+        assert out.getvalue() == b'2.0\n3.0\n3.0\n2.0\n'
+        assert context.diagnostics == [(1, "num() failed: ValueError: could not convert string to float: 'abc'")]
+
+if __name__ == '__main__':
+    test_natives()
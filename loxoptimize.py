@@ -0,0 +1,160 @@
+# loxoptimize.py
+#
+# AST optimizer.  Runs between parsing and execution.  Folds expressions
+# involving only literals, removes if/while branches whose condition is a
+# constant, and drops Grouping nodes (which only exist to record the
+# parentheses).  Anything that would produce a runtime error (e.g., "a" - 1)
+# is left alone so that the error is still reported when it executes.
+
+from loxast import *
+
+def _is_truthy(value):
+    return value is not None and value is not False
+
+def _is_number(value):
+    return type(value) is float
+
+_arithmetic = {
+    '-': lambda left, right: left - right,
+    '*': lambda left, right: left * right,
+    '/': lambda left, right: left / right,
+    '<': lambda left, right: left < right,
+    '<=': lambda left, right: left <= right,
+    '>': lambda left, right: left > right,
+    '>=': lambda left, right: left >= right,
+    }
+
+# Evaluate a binary operator on constants.  Returns a tuple (value,) on
+# success or None if the operation can't be folded.
+def _fold_binary(op, left, right):
+    if op == '==':
+        return (left == right,)
+    elif op == '!=':
+        return (left != right,)
+    elif op == '+':
+        if (_is_number(left) and _is_number(right)) or (isinstance(left, str) and isinstance(right, str)):
+            return (left + right,)
+    elif op in _arithmetic and _is_number(left) and _is_number(right):
+        if op == '/' and right == 0:
+            return None
+        return (_arithmetic[op](left, right),)
+    return None
+
+class LoxOptimizer(NodeVisitor):
+    def __init__(self, context):
+        self.context = context
+
+    # Make a literal to replace an existing node
+    def _literal(self, original, value):
+        node = Literal(value)
+        if self.context:
+            self.context.parser.copy_position(original, node)
+        return node
+
+    # Optimize a statement appearing in a position where a statement is
+    # required (e.g., the body of a loop).
+    def _statement(self, node):
+        node = self.visit(node)
+        return node if node is not None else Statements([])
+
+    # Default.  Optimize all children in-place
+    def visit_Statement(self, node):
+        for name in node._fields:
+            value = getattr(node, name)
+            if isinstance(value, Node):
+                setattr(node, name, self.visit(value))
+            elif isinstance(value, list):
+                value[:] = [ self.visit(item) if isinstance(item, Node) else item for item in value ]
+        return node
+
+    visit_Expression = visit_Statement
+
+    def visit_Statements(self, node):
+        node.statements = [ stmt for stmt in map(self.visit, node.statements) if stmt is not None ]
+        return node
+
+    def visit_Grouping(self, node):
+        return self.visit(node.value)
+
+    def visit_Binary(self, node):
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if isinstance(node.left, Literal) and isinstance(node.right, Literal):
+            result = _fold_binary(node.op, node.left.value, node.right.value)
+            if result:
+                return self._literal(node, result[0])
+        return node
+
+    def visit_Unary(self, node):
+        node.operand = self.visit(node.operand)
+        if isinstance(node.operand, Literal):
+            value = node.operand.value
+            if node.op == '!':
+                return self._literal(node, not _is_truthy(value))
+            elif node.op == '-' and _is_number(value):
+                return self._literal(node, -value)
+        return node
+
+    def visit_Logical(self, node):
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if isinstance(node.left, Literal):
+            if node.op == 'or':
+                return node.left if _is_truthy(node.left.value) else node.right
+            elif node.op == 'and':
+                return node.right if _is_truthy(node.left.value) else node.left
+        return node
+
+    def visit_IfStmt(self, node):
+        node.test = self.visit(node.test)
+        if isinstance(node.test, Literal):
+            if _is_truthy(node.test.value):
+                return self.visit(node.consequence)
+            else:
+                return self.visit(node.alternative) if node.alternative else None
+        node.consequence = self._statement(node.consequence)
+        if node.alternative:
+            node.alternative = self.visit(node.alternative)
+        return node
+
+    def visit_WhileStmt(self, node):
+        node.test = self.visit(node.test)
+        if isinstance(node.test, Literal) and not _is_truthy(node.test.value):
+            return None
+        node.body = self._statement(node.body)
+        return node
+
+# High-level entry point
+def optimize(node, context):
+    return LoxOptimizer(context).visit(node)
+
+def test_optimize():
+    from loxscan import LoxLexer
+    from loxparse import LoxParser
+    lexer = LoxLexer(None)
+    parser = LoxParser(None)
+
+    def opt(source):
+        return optimize(parser.parse(lexer.tokenize(source)), None)
+
+    assert opt("2 + 3 * 4;") == Statements([ExprStmt(Literal(14.0))])
+    assert opt("(2 + 3) * x;") == Statements([ExprStmt(Binary(Literal(5.0), '*', Variable('x')))])
+    assert opt('"a" + "b" == "ab";') == Statements([ExprStmt(Literal(True))])
+    assert opt("-(1 < 2);") == Statements([ExprStmt(Unary('-', Literal(True)))])
+    assert opt('"a" - 1;') == Statements([ExprStmt(Binary(Literal('a'), '-', Literal(1.0)))])
+    assert opt("1 / 0;") == Statements([ExprStmt(Binary(Literal(1.0), '/', Literal(0.0)))])
+    assert opt("nil or x;") == Statements([ExprStmt(Variable('x'))])
+    assert opt("!nil and x;") == Statements([ExprStmt(Variable('x'))])
+    assert opt("if (1 > 2) print x; else print y;") == Statements([Print(Variable('y'))])
+    assert opt("if (false) print x;") == Statements([])
+    assert opt("while (x) if (nil) print x;") == Statements([WhileStmt(Variable('x'), Statements([]))])
+    assert opt("while (false) print x; print y;") == Statements([Print(Variable('y'))])
+
+def test_dead_code_errors():
+    import loxcontext
+    for source, message in [('if (false) print undefinedvar;', 'undefinedvar is not defined'),
+                            ('while (false) { return 1; }', 'return used outside of a function')]:
+        assert loxcontext._diagnose(source) == [(1, message)]
+
+if __name__ == '__main__':
+    test_optimize()
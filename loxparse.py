@@ -4,9 +4,24 @@ from sly import Parser
 from loxast import *
 from loxscan import LoxLexer
 
+# Counting reductions.  sly sets parser.production on every reduction.  This
+# descriptor counts them for parsers that are counting (see
+# LoxParser.parse_counted()).  The count is kept per parser, so parsers on
+# other threads aren't affected.
+class _CountReductions:
+    def __get__(self, parser, cls):
+        return self if parser is None else parser.__dict__.get('production')
+
+    def __set__(self, parser, production):
+        parser.__dict__['production'] = production
+        if parser.counting:
+            parser.reductions += 1
+
 class LoxParser(Parser):
     tokens = LoxLexer.tokens
     expected_shift_reduce = 1
+    production = _CountReductions()
+    counting = False
     precedence = (
         ('right', EQUAL),
         ('left', OR),
@@ -97,8 +112,8 @@ class LoxParser(Parser):
         if p.expression1:
             if not isinstance(body, Statements):
                 body = Statements([body])
-            body.statements.append(ExprStmt(p.expression1))
-        body = WhileStmt(p.expression0 or Literal(True), body)
+            body.statements.append(self._positioned(ExprStmt(p.expression1), p.expression1))
+        body = self._for_loop(p, WhileStmt(p.expression0 or Literal(True), body))
         body = Statements([p.for_initializer, body])
         return body
 
@@ -108,10 +123,21 @@ class LoxParser(Parser):
         if p.expression1:
             if not isinstance(body, Statements):
                 body = Statements([body])
-            body.statements.append(ExprStmt(p.expression1))
-        body = WhileStmt(p.expression0 or Literal(True), body)
+            body.statements.append(self._positioned(ExprStmt(p.expression1), p.expression1))
+        body = self._for_loop(p, WhileStmt(p.expression0 or Literal(True), body))
         return body
     
+    # The statements a for loop turns into get positions so that errors in
+    # them (e.g., hitting a step limit) can be reported.  The loop gets the
+    # position of the whole for statement.
+    def _for_loop(self, p, node):
+        self.set_position(node, p.lineno, (p.index, p.end))
+        return node
+
+    def _positioned(self, node, source):
+        self.copy_position(source, node)
+        return node
+
     @_('var_declaration',
        'expression_statement')
     def for_initializer(self, p):
@@ -221,6 +247,31 @@ class LoxParser(Parser):
     def __init__(self, context):
         self.context = context
 
+    # Parse, leaving the number of reductions made in self.reductions
+    def parse_counted(self, tokens):
+        self.reductions = 0
+        self.counting = True
+        try:
+            return self.parse(tokens)
+        finally:
+            self.counting = False
+
+    # Give a node created after parsing (e.g., by the optimizer) the same
+    # source position as the node it replaces
+    def copy_position(self, source, target):
+        if id(source) in self._line_positions:
+            self._line_positions[id(target)] = self._line_positions[id(source)]
+            self._index_positions[id(target)] = self._index_positions[id(source)]
+
+    # Record the source position of a node (e.g., one loaded from a snapshot).
+    # Without indices, errors are reported without showing the source.
+    def set_position(self, node, lineno, indices=None):
+        if not hasattr(self, '_line_positions'):
+            self._line_positions = { }
+            self._index_positions = { }
+        self._line_positions[id(node)] = lineno
+        self._index_positions[id(node)] = indices
+
 def test_parsing():
     lexer = LoxLexer(None)
     parser = LoxParser(None)
@@ -0,0 +1,174 @@
+# loxprofile.py
+#
+# Lox-level profiler.  Counts calls, own and total time per function and
+# statement executions per line.  Enabled with LoxContext.run(profile=True).
+#
+# Functions are identified cProfile-style as (filename, lineno, name) and the
+# results can be saved in the format read by the pstats module.
+
+import marshal
+import sys
+import time
+
+from loxast import Statement, Statements
+from loxinterp import LoxFunction, LoxClass
+from loxnative import LoxNativeFunction
+
+class FunctionStats:
+    def __init__(self):
+        self.calls = 0
+        self.primitive_calls = 0          # Calls that aren't recursive
+        self.own_time = 0.0
+        self.total_time = 0.0
+        self.callers = { }                # caller key -> [calls, primitive calls, own time, total time]
+
+class LoxProfiler:
+    def __init__(self, context):
+        self.context = context
+        self.functions = { }             # key -> FunctionStats
+        self.statement_hits = { }        # id(node) -> count
+        self._statements = { }           # id(node) -> node
+        self._keys = { }
+        self._active = { }               # key -> number of active calls
+        self._stack = [ ]                # [key, start time, time in callees]
+        self.script_key = (context.filename, 0, '<script>')
+
+    def install(self, interp):
+        interp.instrument(self._wrap, self._call_hook)
+        self._enter(self.script_key)
+
+    def uninstall(self, interp):
+        interp.uninstrument()
+        while self._stack:
+            self._exit()
+
+    def _wrap(self, nodetype, method):
+        if issubclass(nodetype, Statement) and not issubclass(nodetype, Statements):
+            hits = self.statement_hits
+            statements = self._statements
+            def visit_statement(interp, node):
+                key = id(node)
+                if key in hits:
+                    hits[key] += 1
+                else:
+                    hits[key] = 1
+                    statements[key] = node
+                return method(interp, node)
+            return visit_statement
+        return method
+
+    def _call_hook(self, node, callee):
+        self._enter(self._key(callee))
+        return self._exit
+
+    def _key(self, callee):
+        if isinstance(callee, LoxFunction):
+            node = callee.node
+            key = self._keys.get(id(node))
+            if key is None:
+                key = self._keys[id(node)] = (self.context.filename, self._line(node), node.name)
+            return key
+        elif isinstance(callee, LoxClass):
+            return (self.context.filename, 0, callee.name)
+        elif isinstance(callee, LoxNativeFunction):
+            return ('~', 0, str(callee))
+        else:
+            return ('~', 0, type(callee).__name__)
+
+    def _line(self, node):
+        try:
+            return self.context.parser.line_position(node)
+        except KeyError:
+            return 0
+
+    def _enter(self, key):
+        self._stack.append([key, time.perf_counter(), 0.0])
+        self._active[key] = self._active.get(key, 0) + 1
+
+    def _exit(self, value=None):
+        key, start, callee_time = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self._active[key] -= 1
+        primitive = not self._active[key]
+        stats = self.functions.get(key)
+        if stats is None:
+            stats = self.functions[key] = FunctionStats()
+        stats.calls += 1
+        stats.own_time += elapsed - callee_time
+        if primitive:
+            stats.primitive_calls += 1
+            stats.total_time += elapsed
+        if self._stack:
+            caller = self._stack[-1]
+            caller[2] += elapsed
+            edge = stats.callers.setdefault(caller[0], [0, 0, 0.0, 0.0])
+            edge[0] += 1
+            edge[2] += elapsed - callee_time
+            if primitive:
+                edge[1] += 1
+                edge[3] += elapsed
+
+    # Number of statements executed on each line.  Statements made up by the
+    # parser (e.g., the parts of a for loop) may not have a line number.
+    def line_hits(self):
+        lines = { }
+        for key, count in self.statement_hits.items():
+            lineno = self._line(self._statements[key])
+            if lineno:
+                lines[lineno] = lines.get(lineno, 0) + count
+        return lines
+
+    # Statistics in the form used by pstats
+    def pstats(self):
+        return { key: (stats.primitive_calls, stats.calls, stats.own_time, stats.total_time,
+                       { caller: tuple(edge) for caller, edge in stats.callers.items() })
+                 for key, stats in self.functions.items() }
+
+    def dump_stats(self, filename):
+        with open(filename, 'wb') as file:
+            marshal.dump(self.pstats(), file)
+
+    def print_report(self, file=sys.stderr, limit=20):
+        print(f'{"calls":>10} {"own time":>10} {"total time":>10}  function', file=file)
+        for key, stats in sorted(self.functions.items(), key=lambda item: -item[1].own_time)[:limit]:
+            filename, lineno, name = key
+            where = f' ({filename}:{lineno})' if lineno else ''
+            calls = str(stats.calls) if stats.calls == stats.primitive_calls else f'{stats.calls}/{stats.primitive_calls}'
+            print(f'{calls:>10} {stats.own_time:10.6f} {stats.total_time:10.6f}  {name}{where}', file=file)
+        print(file=file)
+        print(f'{"line":>10} {"hits":>10}  source', file=file)
+        lines = self.context.source.splitlines()
+        for lineno, count in sorted(self.line_hits().items(), key=lambda item: -item[1])[:limit]:
+            text = lines[lineno - 1].strip() if lineno <= len(lines) else ''
+            print(f'{lineno:>10} {count:>10}  {text}', file=file)
+
+def test_profiler():
+    import io
+    import os
+    import pstats
+    import tempfile
+    import loxcontext
+    context = loxcontext.LoxContext(output=io.BytesIO())
+    context.parse('''fun fib(n) {
+  if (n < 2) return n;
+  return fib(n - 1) + fib(n - 2);
+}
+class A { init() { this.x = fib(5); } }
+A();
+print fib(10);
+''', 'fib.lox')
+    context.run(profile=True)
+    profiler = context.profiler
+    stats = profiler.functions[('fib.lox', 1, 'fib')]
+    assert stats.calls == 177 + 15 and stats.primitive_calls == 2
+    assert stats.callers[('fib.lox', 0, 'A')][0] == 1
+    assert profiler.functions[('fib.lox', 0, 'A')].calls == 1
+    assert profiler.line_hits()[3] == 88 + 7
+    assert context.interp.__dict__.get('_visitors') is None
+    report = io.StringIO()
+    profiler.print_report(report)
+    assert 'fib (fib.lox:1)' in report.getvalue()
+    with tempfile.TemporaryDirectory() as dirname:
+        filename = os.path.join(dirname, 'fib.prof')
+        profiler.dump_stats(filename)
+        assert pstats.Stats(filename).total_calls == 177 + 15 + 2
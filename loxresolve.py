@@ -1,118 +1,233 @@
 # Variable resolver
 #
-# Walks the AST to determine the proper scope for each variable reference.
+# Walks the AST to determine the proper storage for each variable reference.
+#
+# Each function (and the top-level script) gets a single flat frame.  Every
+# local variable declared anywhere in the function, including in nested
+# blocks, is assigned its own slot in that frame.  The resolver also works
+# out which locals are captured by inner functions (escape analysis).  Only
+# captured locals are stored in heap-allocated cells.  Inner functions refer
+# to them through a list of upvalues that is filled in when the closure is
+# created (the same scheme as clox).  Variables declared at the top level
+# (outside of any block) are globals and are stored by name.
+#
+# Results are attached to the nodes:
+#
+#    Variable, Assign, This            .binding
+#    Super                             .super_binding, .this_binding
+#    VarDeclaration, FuncDeclaration,
+#    ClassDeclaration                  .binding  (where the name is stored)
+#    ClassDeclaration                  .super_binding
+#    FuncDeclaration                   .nslots, .padding, .cells, .upvalues
+#    Return                            .tail  (value is a call in tail position)
 #
 # TODO: Could add more error handling. Better handling of error messages.
 
 from loxast import *
-from collections import ChainMap
 
 class ResolveError(Exception):
     pass
 
-def _resolve_name(name, env:ChainMap):
-    for n, e in enumerate(env.maps):
-        if name in e:
-            if not e[name]:
+# -- Bindings.  Where a variable lives at runtime.
+class LocalBinding:
+    def __init__(self, name, slot):
+        self.name = name
+        self.slot = slot
+        self.defined = False
+        self.captured = False
+
+class UpvalueBinding:
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+
+class GlobalBinding:
+    def __init__(self, name):
+        self.name = name
+
+# Resolution state for a single function
+class _Function:
+    def __init__(self, enclosing, kind):
+        self.enclosing = enclosing
+        self.kind = kind
+        self.scopes = [ ]
+        self.nslots = 0
+        self.upvalues = [ ]               # (is_local, index) pairs
+        self.upvalue_index = { }
+
+    def declare(self, name):
+        binding = self.scopes[-1][name] = LocalBinding(name, self.nslots)
+        self.nslots += 1
+        return binding
+
+    def find_local(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None
+
+    def add_upvalue(self, is_local, index):
+        key = (is_local, index)
+        if key not in self.upvalue_index:
+            self.upvalue_index[key] = len(self.upvalues)
+            self.upvalues.append(key)
+        return self.upvalue_index[key]
+
+    # Find a variable in an enclosing function, threading it through the
+    # upvalues of every function in between.
+    def find_upvalue(self, name):
+        if not self.enclosing:
+            return None
+        local = self.enclosing.find_local(name)
+        if local:
+            local.captured = True
+            return self.add_upvalue(True, local.slot)
+        index = self.enclosing.find_upvalue(name)
+        if index is not None:
+            return self.add_upvalue(False, index)
+        return None
+
+class LoxResolver(NodeVisitor):
+    def __init__(self, globals, context):
+        self.globals = globals              # Global name -> defined flag
+        self.context = context
+        self.function = _Function(None, 'script')
+        self.classkind = None
+
+    def error(self, node, message):
+        self.context.error(node, message)
+
+    def declare(self, name):
+        if self.function.scopes:
+            return self.function.declare(name)
+        self.globals[name] = False
+        return GlobalBinding(name)
+
+    def define(self, binding):
+        if isinstance(binding, LocalBinding):
+            binding.defined = True
+        else:
+            self.globals[binding.name] = True
+
+    def lookup(self, name):
+        local = self.function.find_local(name)
+        if local:
+            if not local.defined:
                 raise ResolveError("Can't reference a variable in its own initialization")
-            else:
-                return n
-    raise ResolveError(f'{name} is not defined')
+            return local
+        index = self.function.find_upvalue(name)
+        if index is not None:
+            return UpvalueBinding(name, index)
+        if name in self.globals:
+            if not self.globals[name]:
+                raise ResolveError("Can't reference a variable in its own initialization")
+            return GlobalBinding(name)
+        raise ResolveError(f'{name} is not defined')
 
-def resolve(node, env:ChainMap, interp):
-    if isinstance(node, Variable):
+    def resolve_name(self, node, name):
         try:
-            interp.localmap[id(node)] = _resolve_name(node.name, env)
+            return self.lookup(name)
         except ResolveError as err:
-            interp.context.error(node, str(err))
-        
-    elif isinstance(node, VarDeclaration):
-        env[node.name] = False
-        if node.initializer:
-            resolve(node.initializer, env, interp)
-        env[node.name] = True
+            self.error(node, str(err))
+
+    # Resolve a function body in a new frame
+    def resolve_function(self, node, kind):
+        function = self.function = _Function(self.function, kind)
+        function.scopes.append({ })
+        params = [ ]
+        if kind == 'method':
+            params.append(function.declare('this'))
+        params.extend(function.declare(p) for p in node.parameters)
+        for binding in params:
+            binding.defined = True
+        # Parameters and the top-level locals of the body share one scope
+        for stmt in node.statements.statements:
+            self.visit(stmt)
+        self.function = function.enclosing
+        node.nslots = function.nslots
+        node.padding = (None,) * (function.nslots - len(params))
+        node.cells = [ binding.slot for binding in params if binding.captured ]
+        node.upvalues = function.upvalues
+
+    # Default.  Resolve all children
+    def visit_Statement(self, node):
+        for child in iter_children(node):
+            self.visit(child)
+
+    visit_Expression = visit_Statement
+
+    def visit_Statements(self, node):
+        self.function.scopes.append({ })
+        for stmt in node.statements:
+            self.visit(stmt)
+        self.function.scopes.pop()
 
-    elif isinstance(node, Assign):
-        resolve(node.value, env, interp)
-        try:
-            interp.localmap[id(node)] = _resolve_name(node.name, env)
-        except ResolveError as err:
-            interp.context.error(node, str(err))
-        
-    elif isinstance(node, FuncDeclaration):
-        env[node.name] = True
-        childenv = env.new_child()
-        childenv['fun'] = True
-        for p in node.parameters:
-            childenv[p] = len(childenv)
-        resolve(node.statements, childenv, interp)
-
-    elif isinstance(node, ClassDeclaration):
-        env[node.name] = True        
+    def visit_Variable(self, node):
+        node.binding = self.resolve_name(node, node.name)
+
+    def visit_VarDeclaration(self, node):
+        node.binding = self.declare(node.name)
+        if node.initializer:
+            self.visit(node.initializer)
+        self.define(node.binding)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        node.binding = self.resolve_name(node, node.name)
+
+    def visit_FuncDeclaration(self, node):
+        node.binding = self.declare(node.name)
+        self.define(node.binding)
+        self.resolve_function(node, 'function')
+
+    def visit_ClassDeclaration(self, node):
+        node.binding = self.declare(node.name)
+        self.define(node.binding)
+        enclosing = self.classkind
+        self.classkind = 'class'
         if node.superclass:
             if node.superclass.name == node.name:
-                interp.context.error(node, "A class can't inherit from itself")
-            resolve(node.superclass, env, interp)
-            env = env.new_child()
-            env['super'] = True
-        env = env.new_child()
-        env['this'] = True
+                self.error(node, "A class can't inherit from itself")
+            self.visit(node.superclass)
+            self.classkind = 'subclass'
+            self.function.scopes.append({ })
+            node.super_binding = self.function.declare('super')
+            node.super_binding.defined = True
         for meth in node.methods:
-            resolve(meth, env, interp)
-        
-    elif isinstance(node, Literal):
-        pass
-
-    elif isinstance(node, (Binary, Logical)):
-        resolve(node.left, env, interp)
-        resolve(node.right, env, interp)
-
-    elif isinstance(node, Unary):
-        resolve(node.operand, env, interp)
-
-    elif isinstance(node, Call):
-        resolve(node.func, env, interp)
-        for arg in node.arguments:
-            resolve(arg, env, interp)
-
-    elif isinstance(node, (Grouping, Print, ExprStmt)):
-        resolve(node.value, env, interp)
-
-    elif isinstance(node, Return):
-        resolve(node.value, env, interp)
-        if 'fun' not in env:
-            interp.context.error(node, 'return used outside of a function')
-        
-    elif isinstance(node, IfStmt):
-        resolve(node.test, env, interp)
-        resolve(node.consequence, env, interp)
-        if (node.alternative):
-            resolve(node.alternative, env, interp)
-
-    elif isinstance(node, WhileStmt):
-        resolve(node.test, env, interp)
-        resolve(node.body, env, interp)
-
-    elif isinstance(node, Statements):
-        newenv = env.new_child()
-        for stmt in node.statements:
-            resolve(stmt, newenv, interp)
-
-    elif isinstance(node, Get):
-        resolve(node.object, env, interp)
-
-    elif isinstance(node, Set):
-        resolve(node.object, env, interp)
-        resolve(node.value, env, interp)
-
-    elif isinstance(node, This):
-        if 'this' in env:
-            interp.localmap[id(node)] = _resolve_name('this', env)
+            self.resolve_function(meth, 'method')
+        if node.superclass:
+            self.function.scopes.pop()
+        self.classkind = enclosing
+
+    def visit_Return(self, node):
+        self.visit(node.value)
+        node.tail = isinstance(node.value, Call)
+        if self.function.kind == 'script':
+            self.error(node, 'return used outside of a function')
+
+    def visit_This(self, node):
+        if self.classkind:
+            node.binding = self.resolve_name(node, 'this')
         else:
-            interp.context.error(node, "'this' used outside of a class")
+            self.error(node, "'this' used outside of a class")
 
-    elif isinstance(node, Super):
-        if 'super' in env:
-            interp.localmap[id(node)] = _resolve_name('super', env)
+    def visit_Super(self, node):
+        if self.classkind == 'subclass':
+            node.super_binding = self.resolve_name(node, 'super')
+            node.this_binding = self.resolve_name(node, 'this')
         else:
-            interp.context.error(node, "'super' used outside of a class")
+            self.error(node, "'super' used outside of a class")
+
+# High-level entry point.  Resolves a program using the given dict of global
+# names.  Top-level statements are in the global scope.  Returns the number of
+# slots needed in the frame for the top-level code (for locals of blocks).
+def resolve(node, globals, context):
+    resolver = LoxResolver(globals, context)
+    for stmt in (node.statements if isinstance(node, Statements) else [node]):
+        resolver.visit(stmt)
+    return resolver.function.nslots
+
+# Check a program for the errors resolve() reports, without changing globals.
+# Used before the optimizer prunes dead code, which resolve() then never sees.
+def check(node, globals, context):
+    resolve(node, dict(globals), context)
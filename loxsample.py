@@ -0,0 +1,131 @@
+# loxsample.py
+#
+# Sampling profiler.  A background thread periodically looks at the Python
+# stack of the thread running a Lox program and works out the Lox call stack
+# from it: the active LoxFunction invocations and the line each of them is
+# at.  Nothing is added to the interpreter itself, so the cost to the
+# program is only the time the sampling thread holds the GIL.
+#
+# Results are written in the "collapsed stack" format used by flame graph
+# tools (flamegraph.pl, speedscope, etc.), one stack per line:
+#
+#     <script>:12;fib:5;fib:5;fib:4 37
+#
+#     with loxsample.LoxSampler(context) as sampler:
+#         context.run()
+#     sampler.write_collapsed(file)
+
+import sys
+import threading
+
+from loxinterp import LoxFunction
+import loxgeninterp
+
+# Code objects of the Python functions that hold a Lox invocation (in their
+# local variable func) and of the stackless trampoline.
+_invoke_codes = { LoxFunction.invoke.__code__, loxgeninterp.LoxGenInterpreter._gen_invoke.__code__ }
+_trampoline_code = loxgeninterp.LoxGenInterpreter._run_stack.__code__
+
+class LoxSampler:
+    def __init__(self, context, interval=0.005):
+        self.context = context
+        self.interval = interval
+        self.counts = { }                # Stack (tuple of labels) -> number of samples
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Start sampling the calling thread
+    def start(self):
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                stack = self.lox_stack(frame)
+                if stack:
+                    self.counts[stack] = self.counts.get(stack, 0) + 1
+
+    # Lox call stack (outermost first) for a Python stack, or None if no Lox
+    # code is running
+    def lox_stack(self, frame):
+        labels = [ ]
+        line = None
+        running = False
+        for f in _walk_frames(frame):
+            code = f.f_code
+            if code in _invoke_codes:
+                func = f.f_locals.get('func')
+                if isinstance(func, LoxFunction):
+                    labels.append(f'{func.node.name}:{line or "?"}')
+                line = None
+            elif 'node' in code.co_varnames:
+                running = True
+                if line is None:
+                    line = self._line(f.f_locals.get('node'))
+        if not running:
+            return None
+        labels.append(f'<script>:{line or "?"}')
+        return tuple(reversed(labels))
+
+    def _line(self, node):
+        try:
+            return self.context.parser.line_position(node)
+        except KeyError:
+            return None
+
+    def collapsed(self):
+        return [ f'{";".join(stack)} {count}' for stack, count in sorted(self.counts.items()) ]
+
+    def write_collapsed(self, file):
+        for line in self.collapsed():
+            print(line, file=file)
+
+# Python frames from the innermost out.  In stackless mode, the generators
+# suspended on the trampoline's stack are included where the trampoline is.
+def _walk_frames(frame):
+    while frame is not None:
+        yield frame
+        if frame.f_code is _trampoline_code:
+            for gen in reversed(frame.f_locals.get('stack', ())):
+                if gen.gi_frame is not None:
+                    yield gen.gi_frame
+        frame = frame.f_back
+
+def test_sampler():
+    import io
+    import loxcontext
+    source = '''
+fun inner(n) {
+  var i = 0;
+  while (i < n) i = i + 1;
+  return i;
+}
+fun outer() {
+  return inner(200000) + 1;
+}
+outer();
+'''
+    for stackless in (False, True):
+        context = loxcontext.LoxContext(output=io.BytesIO())
+        context.parse(source)
+        with LoxSampler(context, interval=0.001) as sampler:
+            context.run(stackless=stackless)
+        assert any(stack[:3] == ('<script>:10', 'outer:8', 'inner:4') for stack in sampler.counts)
+        out = io.StringIO()
+        sampler.write_collapsed(out)
+        assert '<script>:10;outer:8;inner:4 ' in out.getvalue()
@@ -0,0 +1,240 @@
+# loxserver.py
+#
+# Long-running execution server.  Keeps a pool of worker processes that have
+# already imported the interpreter and built the parser tables, so that
+# running a small script doesn't pay for interpreter startup.  Each script
+# gets a fresh LoxContext.
+#
+# Requests and responses are JSON objects, one per line, read from stdin and
+# written to stdout, or exchanged over a Unix socket (--socket PATH).  A
+# request is either a single script
+#
+#     {"id": 1, "source": "print 2 + 3;", "max_steps": 100000,
+#      "timeout": 1.0, "max_memory": 1000000}
+#
+# (everything except "source" is optional) or a batch of scripts that are run
+# in parallel
+#
+#     {"id": 2, "batch": [ {"source": ...}, {"source": ...} ]}
+#
+# The response to a script is
+#
+#     {"id": 1, "ok": true, "output": "5.0\n", "errors": [], "metrics": {...}}
+#
+# where errors is a list of [lineno, message] diagnostics and metrics gives
+# the time spent in each phase (see loxmetrics).  The response to a
+# batch is {"id": 2, "results": [ ... ]} with one response per script.
+#
+# Scripts that don't give a max_steps or timeout get the server's defaults
+# (--max-steps and --timeout), so a runaway script can't tie up a worker
+# forever.  Requests on stdin are handled concurrently, so responses may come
+# back in a different order than the requests; use "id" to match them up.
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import socketserver
+import sys
+import threading
+
+import loxcontext
+
+# Default limits on scripts
+DEFAULT_MAX_STEPS = 100_000_000
+DEFAULT_TIMEOUT = 60.0
+
+# Run a single script in a fresh context.  Never raises: anything that goes
+# wrong is reported in the response.
+def run_script(request):
+    output = io.BytesIO()
+    errors = io.StringIO()
+    try:
+        context = loxcontext.LoxContext(output=output, errors=errors, max_memory=request.get('max_memory'))
+    except Exception as err:
+        return _error_response(request.get('id'), f'Internal error: {type(err).__name__}: {err}')
+    try:
+        context.parse(request['source'])
+        context.run(request.get('max_steps'), request.get('timeout'))
+    except Exception as err:
+        context.diagnostics.append((None, f'Internal error: {type(err).__name__}: {err}'))
+        context.have_errors = True
+    return {
+        'id': request.get('id'),
+        'ok': not context.have_errors,
+        'output': output.getvalue().decode('utf-8'),
+        'errors': context.diagnostics,
+        'metrics': context.metrics,
+        }
+
+def _error_response(id, message):
+    return { 'id': id, 'ok': False, 'errors': [[None, message]] }
+
+# Worker startup.  Parse and run a small program so that everything the
+# interpreter uses is imported and initialized before the first request.
+def _warm_worker():
+    run_script({'source': 'fun f(x) { return x + 1; } class A { } print f(1); A();'})
+
+class LoxServer:
+    def __init__(self, workers=None, maxtasksperchild=None, max_steps=DEFAULT_MAX_STEPS, timeout=DEFAULT_TIMEOUT):
+        self.pool = multiprocessing.Pool(workers, initializer=_warm_worker,
+                                         maxtasksperchild=maxtasksperchild)
+        self.defaults = { 'max_steps': max_steps, 'timeout': timeout }
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    # Check the scripts in a request, filling in the default limits
+    def _scripts(self, request):
+        if 'batch' in request:
+            scripts = request['batch']
+            if not isinstance(scripts, list):
+                raise ValueError('batch must be a list')
+        else:
+            scripts = [ request ]
+        for script in scripts:
+            if not isinstance(script, dict):
+                raise ValueError('Scripts must be JSON objects')
+            if not isinstance(script.get('source'), str):
+                raise ValueError('Scripts must have a source string')
+        return [ dict(script, **{ name: value for name, value in self.defaults.items()
+                                  if script.get(name) is None })
+                 for script in scripts ]
+
+    # Start handling a request.  respond is called with the response (possibly
+    # in another thread) when it's done.
+    def submit(self, request, respond):
+        scripts = self._scripts(request)
+        def failed(err):
+            respond(_error_response(request.get('id'), f'Internal error: {type(err).__name__}: {err}'))
+        if 'batch' in request:
+            self.pool.map_async(run_script, scripts,
+                                callback=lambda results: respond({ 'id': request.get('id'), 'results': results }),
+                                error_callback=failed)
+        else:
+            self.pool.apply_async(run_script, scripts, callback=respond, error_callback=failed)
+
+    def handle(self, request):
+        responses = queue.Queue()
+        self.submit(request, responses.put)
+        return responses.get()
+
+    # Handle one line of input.  respond is called with one line of output.
+    def submit_line(self, line, respond):
+        def respond_json(response):
+            respond(json.dumps(response) + '\n')
+        request = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            self.submit(request, respond_json)
+        except ValueError as err:
+            id = request.get('id') if isinstance(request, dict) else None
+            respond_json(_error_response(id, f'Bad request: {err}'))
+        except Exception as err:
+            id = request.get('id') if isinstance(request, dict) else None
+            respond_json(_error_response(id, f'Internal error: {type(err).__name__}: {err}'))
+
+    # Handle one line of input, returning one line of output
+    def handle_line(self, line):
+        responses = queue.Queue()
+        self.submit_line(line, responses.put)
+        return responses.get()
+
+    # Requests are handled concurrently, and responses are written as they
+    # finish.  Returns once every request has been answered.
+    def serve_stdio(self, infile=sys.stdin, outfile=sys.stdout):
+        done = threading.Condition()
+        pending = 0
+
+        def respond(line):
+            nonlocal pending
+            with done:
+                outfile.write(line)
+                outfile.flush()
+                pending -= 1
+                done.notify()
+
+        for line in infile:
+            if line.strip():
+                with done:
+                    pending += 1
+                self.submit_line(line, respond)
+        with done:
+            done.wait_for(lambda: pending == 0)
+
+    def serve_socket(self, path):
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(server.handle_line(line.decode('utf-8')).encode('utf-8'))
+                        self.wfile.flush()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as sockserver:
+            try:
+                sockserver.serve_forever()
+            finally:
+                os.unlink(path)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='lox.py --server')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--socket', default=None, help='listen on a Unix socket instead of stdin/stdout')
+    parser.add_argument('--max-tasks', type=int, default=None, help='scripts run by a worker before it is replaced')
+    parser.add_argument('--max-steps', type=int, default=DEFAULT_MAX_STEPS,
+                        help='default step limit for scripts')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='default time limit for scripts, in seconds')
+    args = parser.parse_args(argv)
+    server = LoxServer(args.workers, args.max_tasks, args.max_steps, args.timeout)
+    try:
+        if args.socket:
+            server.serve_socket(args.socket)
+        else:
+            server.serve_stdio()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+def test_run_script():
+    response = run_script({'id': 7, 'source': 'print 2 + 3; print x;'})
+    assert response['id'] == 7 and not response['ok']
+    assert response['output'] == ''
+    assert response['errors'] == [(1, 'x is not defined')]
+    response = run_script({'source': 'while (true) { }', 'max_steps': 100})
+    assert response['errors'] == [(1, 'Step limit exceeded')]
+    response = run_script({'source': 'print "a" + "b";'})
+    assert response['ok'] and response['output'] == 'ab\n'
+
+def test_server():
+    server = LoxServer(2, max_steps=1000)
+    try:
+        for line in ['{"id": 1, "batch": [1]}', '{"id": 1, "batch": 1}', '{"id": 1}', '[]', 'nonsense']:
+            response = json.loads(server.handle_line(line))
+            assert not response['ok'] and response['errors'][0][1].startswith('Bad request')
+        # The server's default step limit applies
+        response = json.loads(server.handle_line('{"id": 2, "source": "while (true) { }"}'))
+        assert response['id'] == 2 and response['errors'] == [[1, 'Step limit exceeded']]
+        out = io.StringIO()
+        server.serve_stdio(io.StringIO('{"id": 3, "source": "print 3;"}\n'
+                                       '{"id": 4, "batch": [{"source": "print 4;"}, {"source": "print x;"}]}\n'
+                                       '{"id": 5, "batch": [null]}\n'), out)
+        responses = { response['id']: response for response in map(json.loads, out.getvalue().splitlines()) }
+        assert responses[3]['output'] == '3.0\n'
+        assert [ result['ok'] for result in responses[4]['results'] ] == [True, False]
+        assert not responses[5]['ok']
+    finally:
+        server.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,189 @@
+# loxsnapshot.py
+#
+# Heap snapshots.  LoxContext.snapshot(filename) saves the global variables
+# of a program that has run, along with everything they refer to (classes,
+# functions and their closures, instances, strings, collections and the AST
+# of every function), using pickle.  LoxContext.restore(filename) loads them
+# into another context, which can then run new code using them without
+# parsing or running the code that built them:
+#
+#     context.parse(setup_source)
+#     context.run()
+#     context.snapshot('app.snapshot')
+#     ...
+#     context = loxcontext.LoxContext()
+#     context.restore('app.snapshot')
+#     context.parse(request_source)
+#     context.run()
+#
+# Native functions that are globals (the built-in natives and any added with
+# define_native()) are saved by name.  They're looked up in the restoring
+# context, so natives added with define_native() must be added again before
+# restoring.  The line numbers of the saved AST nodes are saved too, so errors
+# in restored functions are reported with their line in the original source
+# (but without the source excerpt).  Restored objects aren't counted by
+# memory accounting.
+#
+# Loading a pickle can normally run arbitrary code, so restore() only allows
+# the classes of the Lox modules, built-in containers and the functions that
+# rebuild arrays (see _SnapshotUnpickler.find_class) and rejects anything else.
+# A snapshot still decides what the restored program does, though, so only
+# restore snapshots from a trusted source.
+
+import pickle
+
+from loxast import Node
+from loxnative import LoxNativeFunction
+
+MAGIC = 'lox-snapshot'
+VERSION = 1
+
+class _SnapshotPickler(pickle.Pickler):
+    def __init__(self, file, context):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.context = context
+        self.globals = context.interp.globals
+        self.positions = [ ]              # (node, lineno)
+
+    def persistent_id(self, obj):
+        if isinstance(obj, LoxNativeFunction) and self.globals.get(obj.name) is obj:
+            return ('native', obj.name)
+        return None
+
+    # Called for every object pickled.  Collects the line numbers of nodes.
+    def reducer_override(self, obj):
+        if isinstance(obj, Node):
+            try:
+                self.positions.append((obj, self.context.parser.line_position(obj)))
+            except (KeyError, AttributeError):
+                pass
+        return NotImplemented
+
+# Modules whose classes can be in a snapshot
+_lox_modules = { 'loxast', 'loxinterp', 'loxresolve', 'loxarray', 'loxcollections', 'loxvector' }
+
+# Anything else that can be in a snapshot, as (module, name)
+_allowed = {
+    *(('builtins', name) for name in ('list', 'dict', 'set', 'frozenset', 'tuple', 'bytes', 'bytearray',
+                                      'bool', 'int', 'float', 'str')),
+    ('collections', 'OrderedDict'),
+    ('array', 'array'),
+    ('array', '_array_reconstructor'),
+    *((f'numpy.{core}.{module}', name) for core in ('core', '_core')
+                                       for module, name in (('multiarray', '_reconstruct'),
+                                                            ('multiarray', 'scalar'),
+                                                            ('numeric', '_frombuffer'))),
+    ('numpy', 'ndarray'),
+    ('numpy', 'dtype'),
+    }
+
+class _SnapshotUnpickler(pickle.Unpickler):
+    def __init__(self, file, context):
+        super().__init__(file)
+        self.globals = context.interp.globals
+
+    def find_class(self, module, name):
+        if (module, name) in _allowed:
+            return super().find_class(module, name)
+        if module in _lox_modules:
+            cls = super().find_class(module, name)
+            # Only classes defined there, not functions or imported modules
+            if isinstance(cls, type) and cls.__module__ == module:
+                return cls
+        raise pickle.UnpicklingError(f"Snapshot refers to {module}.{name}, which isn't allowed")
+
+    def persistent_load(self, pid):
+        kind, name = pid
+        if kind != 'native' or name not in self.globals:
+            raise pickle.UnpicklingError(f'Native function {name!r} is not defined')
+        return self.globals[name]
+
+def save(context, file):
+    pickler = _SnapshotPickler(file, context)
+    pickler.dump((MAGIC, VERSION))
+    pickler.dump(context.interp.globals)
+    # Nodes already pickled above are written as references, so the positions
+    # are attached to the same node objects when loaded
+    pickler.dump(pickler.positions)
+
+def load(context, file):
+    unpickler = _SnapshotUnpickler(file, context)
+    if unpickler.load() != (MAGIC, VERSION):
+        raise ValueError('Not a Lox snapshot (or from an incompatible version)')
+    globals = unpickler.load()
+    positions = unpickler.load()
+    for name, value in globals.items():
+        context.interp.define_global(name, value)
+    for node, lineno in positions:
+        context.parser.set_position(node, lineno)
+
+def test_snapshot():
+    import io
+    import loxast
+    import loxcontext
+    setup = '''
+class Counter {
+  init(name) { this.name = name; this.count = 0; }
+  bump() { this.count = this.count + 1; return this.count; }
+}
+fun make_adder(n) { fun add(x) { return x + n; } return add; }
+var counters = Map();
+counters.set("a", Counter("a"));
+var add2 = make_adder(2);
+var greeting = "hello" + " " + "world";
+var t = clock;
+fun fail() {
+  return nil + 1;
+}
+'''
+    context = loxcontext.LoxContext(output=io.BytesIO())
+    context.define_native('twice', lambda x: 2 * x)
+    context.parse(setup, 'setup.lox')
+    context.run()
+    file = io.BytesIO()
+    context.snapshot(file)
+
+    out = io.BytesIO()
+    restored = loxcontext.LoxContext(output=out, errors=io.StringIO())
+    restored.define_native('twice', lambda x: 2 * x)
+    file.seek(0)
+    restored.restore(file)
+    restored.parse('''
+var c = counters.get("a");
+c.bump();
+print c.bump();
+print add2(twice(20));
+print greeting;
+print t == clock;
+counters.set("b", Counter("b"));
+print counters.length();
+fail();
+''')
+    restored.run()
+    assert out.getvalue() == b'2.0\n42.0\nhello world\nTrue\n2.0\n'
+    # Line number from the restored function's original source
+    assert restored.diagnostics == [(13, '+ operands must be numbers')]
+
+    missing = loxcontext.LoxContext(output=io.BytesIO())
+    file.seek(0)
+    try:
+        missing.restore(file)
+        assert False, 'expected UnpicklingError'
+    except pickle.UnpicklingError as err:
+        assert 'twice' in str(err)
+
+    # Pickles that would run other code are rejected
+    class Exploit:
+        def __reduce__(self):
+            import os
+            return (os.system, ('echo pwned',))
+    for payload in [Exploit(), loxast.walk]:
+        file = io.BytesIO()
+        pickle.dump((MAGIC, VERSION), file)
+        pickle.dump(payload, file)
+        file.seek(0)
+        try:
+            loxcontext.LoxContext(output=io.BytesIO()).restore(file)
+            assert False, 'expected UnpicklingError'
+        except pickle.UnpicklingError as err:
+            assert "isn't allowed" in str(err)
@@ -0,0 +1,81 @@
+# loxspecialize.py
+#
+# Post-resolution specialization pass.  Rewrites each generic Binary/Unary
+# node in-place to the node class for its specific operator.  The interpreter
+# then dispatches straight to a handler for the operator instead of testing
+# node.op on every evaluation.  Variable/Assign nodes are likewise rewritten
+# according to where the resolver decided the variable is stored, and Return
+# nodes holding a tail call become TailReturn.  Node identity is preserved so
+# position information remains valid.
+
+from loxast import *
+from loxresolve import LocalBinding, UpvalueBinding
+
+_binary_nodes = {
+    '+': Add,
+    '-': Subtract,
+    '*': Multiply,
+    '/': Divide,
+    '<': Less,
+    '<=': LessEqual,
+    '>': Greater,
+    '>=': GreaterEqual,
+    '==': Equal,
+    '!=': NotEqual,
+    }
+
+_unary_nodes = {
+    '-': Negate,
+    '!': Not,
+    }
+
+# Storage class of a binding -> (Variable class, Assign class)
+def _storage(binding):
+    if isinstance(binding, LocalBinding):
+        if binding.captured:
+            return (CellVariable, CellAssign), binding.slot
+        else:
+            return (LocalVariable, LocalAssign), binding.slot
+    elif isinstance(binding, UpvalueBinding):
+        return (UpvalueVariable, UpvalueAssign), binding.index
+    else:
+        return (GlobalVariable, GlobalAssign), None
+
+# Rewrite a single Binary or Unary node.  Returns False if the operator
+# isn't known.
+def specialize_operator(node):
+    nodes = _binary_nodes if type(node) is Binary else _unary_nodes
+    if node.op not in nodes:
+        return False
+    node.become(nodes[node.op])
+    return True
+
+def specialize(node):
+    for n in walk(node):
+        if type(n) in (Binary, Unary):
+            specialize_operator(n)
+        elif type(n) in (Variable, Assign):
+            classes, n.slot = _storage(n.binding)
+            n.become(classes[type(n) is Assign])
+        elif type(n) is Return and n.tail:
+            n.become(TailReturn)
+
+def test_specialize():
+    tree = Statements([ExprStmt(Binary(Unary('-', Literal(2.0)), '*', Binary(Literal(3.0), '!=', Literal(4.0))))])
+    specialize(tree)
+    expr = tree.statements[0].value
+    assert type(expr) is Multiply
+    assert type(expr.left) is Negate
+    assert type(expr.right) is NotEqual
+    assert expr.right.op == '!='
+
+    local = LocalBinding('x', 2)
+    tree = Statements([ExprStmt(Assign('x', Variable('x')))])
+    tree.statements[0].value.binding = tree.statements[0].value.value.binding = local
+    specialize(tree)
+    assert type(tree.statements[0].value) is LocalAssign
+    assert type(tree.statements[0].value.value) is LocalVariable
+    assert tree.statements[0].value.value.slot == 2
+
+if __name__ == '__main__':
+    test_specialize()
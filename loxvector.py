@@ -0,0 +1,323 @@
+# loxvector.py
+#
+# Vectorized execution of numeric kernels.  vectorize(func) returns a
+# function that can be called with Arrays (see loxarray) in place of any of
+# func's number arguments.  It then computes func for every element at once
+# and returns an Array of the results (true and false become 1 and 0):
+#
+#     fun in_mandelbrot(x0, y0, n) { ... }
+#     var in_set = vectorize(in_mandelbrot);
+#     var row = in_set(xs, y, 1000);       // xs is an Array of x coordinates
+#
+# Called with only numbers, it's an ordinary call of func.
+#
+# func must be a kernel: only local variables and parameters holding numbers
+# or booleans, arithmetic and comparisons, assignments, if, while and return.
+# No calls, globals, printing, strings, objects or closures.  vectorize()
+# reports why a function doesn't qualify.
+#
+# A kernel is run on all of the elements together using NumPy, one AST node
+# at a time.  Each element (lane) keeps its own values, and masks record which
+# lanes are executing each statement.  A while loop keeps going as long as any
+# lane is still in it, and lanes that have returned are masked off.  Each
+# round of a loop counts as one step for the step limit.  Without NumPy, func
+# is simply called once per element.
+
+import array
+
+from loxast import (Statements, VarDeclaration, ExprStmt, IfStmt, WhileStmt, Return, Literal, Binary, Logical,
+                    Unary, Grouping, Variable, Assign)
+from loxinterp import LoxFunction, LoxCallError
+from loxnative import LoxNativeError, native
+from loxresolve import LocalBinding
+from loxarray import LoxArray
+import loxarray
+
+NUMBER = 'number'
+BOOLEAN = 'boolean'
+
+class KernelError(Exception):
+    pass
+
+# Static check that a function is a kernel.  Works out the type (NUMBER or
+# BOOLEAN) of every variable and expression and raises KernelError for
+# anything that isn't allowed.  A variable has no type until it's definitely
+# been assigned, so a variable that might be read while still nil is caught.
+class _KernelChecker:
+    def __init__(self, func):
+        self.returns = set()
+        self.types = { len(func.receiver) + n: NUMBER for n in range(func.arity) }
+
+    def check(self, node):
+        body = node.statements.statements
+        if not body or not isinstance(body[-1], Return):
+            raise KernelError('it must end with a return statement')
+        self.statements(body)
+        if len(self.returns) != 1:
+            raise KernelError('it returns both numbers and booleans')
+
+    def statements(self, statements):
+        for stmt in statements:
+            self.statement(stmt)
+
+    def statement(self, node):
+        if isinstance(node, Statements):
+            self.statements(node.statements)
+        elif isinstance(node, VarDeclaration):
+            slot = self.slot(node)
+            self.types[slot] = self.expression(node.initializer) if node.initializer else None
+        elif isinstance(node, ExprStmt) and isinstance(node.value, Assign):
+            self.assign(self.slot(node.value), self.expression(node.value.value))
+        elif isinstance(node, IfStmt):
+            self.test(node.test)
+            before = dict(self.types)
+            self.statement(node.consequence)
+            consequence = self.types
+            self.types = dict(before)
+            if node.alternative:
+                self.statement(node.alternative)
+            # Variables assigned in only one branch are still unassigned
+            self.types = { slot: kind if consequence.get(slot) == kind else before.get(slot)
+                           for slot, kind in self.types.items() }
+        elif isinstance(node, WhileStmt):
+            self.test(node.test)
+            before = dict(self.types)
+            self.statement(node.body)
+            # The body might not run
+            self.types = { slot: before.get(slot) for slot in self.types }
+        elif isinstance(node, Return):
+            self.returns.add(self.expression(node.value))
+        else:
+            raise KernelError(f'{type(node).__name__} statements are not allowed')
+
+    def slot(self, node):
+        if not isinstance(node.binding, LocalBinding) or node.binding.captured:
+            raise KernelError(f'{node.name!r} is not a local variable')
+        return node.binding.slot
+
+    def assign(self, slot, kind):
+        if self.types.get(slot, kind) not in (None, kind):
+            raise KernelError('a variable holds both numbers and booleans')
+        self.types[slot] = kind
+
+    def test(self, node):
+        if self.expression(node) != BOOLEAN:
+            raise KernelError('conditions must be comparisons or booleans')
+
+    def expression(self, node):
+        if isinstance(node, Literal):
+            if type(node.value) is float:
+                return NUMBER
+            elif type(node.value) is bool:
+                return BOOLEAN
+            raise KernelError('only numbers and booleans are allowed')
+        elif isinstance(node, Variable):
+            kind = self.types.get(self.slot(node))
+            if kind is None:
+                raise KernelError(f'{node.name!r} might be used before it is assigned')
+            return kind
+        elif isinstance(node, Grouping):
+            return self.expression(node.value)
+        elif isinstance(node, Binary) and node.op in _numpy_binary:
+            left = self.expression(node.left)
+            right = self.expression(node.right)
+            if node.op in ('==', '!='):
+                if left != right:
+                    raise KernelError('comparison of a number with a boolean')
+                return BOOLEAN
+            if left != NUMBER or right != NUMBER:
+                raise KernelError(f'{node.op} operands must be numbers')
+            return BOOLEAN if node.op in ('<', '<=', '>', '>=') else NUMBER
+        elif isinstance(node, Unary) and node.op in ('-', '!'):
+            kind = NUMBER if node.op == '-' else BOOLEAN
+            if self.expression(node.operand) != kind:
+                raise KernelError(f'bad operand for {node.op}')
+            return kind
+        elif isinstance(node, Logical):
+            if self.expression(node.left) != BOOLEAN or self.expression(node.right) != BOOLEAN:
+                raise KernelError(f'{node.op} operands must be booleans')
+            return BOOLEAN
+        raise KernelError(f'{type(node).__name__} expressions are not allowed')
+
+_numpy_binary = {
+    '+': 'add',
+    '-': 'subtract',
+    '*': 'multiply',
+    '/': 'divide',
+    '<': 'less',
+    '<=': 'less_equal',
+    '>': 'greater',
+    '>=': 'greater_equal',
+    '==': 'equal',
+    '!=': 'not_equal',
+    }
+
+# Run a kernel over arrays.  Values are NumPy arrays (or scalars, which
+# broadcast) kept by frame slot.  Each statement method gets the mask of
+# lanes executing it and returns the lanes that carry on after it.
+class _KernelRun:
+    def __init__(self, interp, func, args, size):
+        numpy = loxarray.numpy
+        self.interp = interp
+        self.numpy = numpy
+        self.values = { len(func.receiver) + n: arg for n, arg in enumerate(args) }
+        self.result = numpy.zeros(size)
+        self.returned = numpy.zeros(size, dtype=bool)
+        self.statements(func.body, numpy.ones(size, dtype=bool))
+
+    def statements(self, statements, active):
+        for stmt in statements:
+            if not active.any():
+                break
+            active = self.statement(stmt, active)
+        return active
+
+    def statement(self, node, active):
+        numpy = self.numpy
+        if isinstance(node, Statements):
+            return self.statements(node.statements, active)
+        elif isinstance(node, VarDeclaration):
+            value = self.expression(node.initializer) if node.initializer else 0.0
+            self.values[node.binding.slot] = numpy.where(active, value, value)
+        elif isinstance(node, ExprStmt):
+            slot = node.value.binding.slot
+            self.values[slot] = numpy.where(active, self.expression(node.value.value), self.values[slot])
+        elif isinstance(node, IfStmt):
+            test = self.expression(node.test)
+            self.statement(node.consequence, active & test)
+            if node.alternative:
+                self.statement(node.alternative, active & ~test)
+        elif isinstance(node, WhileStmt):
+            interp = self.interp
+            looping = active
+            while True:
+                looping = looping & self.expression(node.test)
+                if not looping.any():
+                    break
+                looping = self.statement(node.body, looping)
+                interp.ticks -= 1
+                if interp.ticks < 0:
+                    interp.check_limits(node)
+        elif isinstance(node, Return):
+            self.result = numpy.where(active, self.expression(node.value), self.result)
+            self.returned |= active
+        return active & ~self.returned
+
+    def expression(self, node):
+        if isinstance(node, Literal):
+            return node.value
+        elif isinstance(node, Variable):
+            return self.values[node.binding.slot]
+        elif isinstance(node, Grouping):
+            return self.expression(node.value)
+        elif isinstance(node, Binary):
+            return getattr(self.numpy, _numpy_binary[node.op])(self.expression(node.left),
+                                                               self.expression(node.right))
+        elif isinstance(node, Unary):
+            operand = self.expression(node.operand)
+            return self.numpy.negative(operand) if node.op == '-' else self.numpy.logical_not(operand)
+        elif isinstance(node, Logical):
+            func = self.numpy.logical_and if node.op == 'and' else self.numpy.logical_or
+            return func(self.expression(node.left), self.expression(node.right))
+
+class LoxVectorFunction:
+    def __init__(self, func):
+        self.func = func
+        self.arity = func.arity
+
+    def __str__(self):
+        return f'<vectorized fn {self.func.node.name}>'
+
+    def __call__(self, interp, *args):
+        if len(args) != self.arity:
+            raise LoxCallError(f"Expected {self.arity} arguments")
+        sizes = { len(arg) for arg in args if isinstance(arg, LoxArray) }
+        if not sizes:
+            return self.func.invoke(interp, args)
+        if len(sizes) > 1:
+            raise LoxNativeError('Array lengths differ')
+        if any(not isinstance(arg, (float, LoxArray)) for arg in args):
+            raise LoxNativeError('Arguments must be numbers or arrays')
+        size = sizes.pop()
+        result = LoxArray(None)
+        if interp.memory:
+            result.charge(interp.memory, size)
+        if loxarray.numpy is None:
+            result.data = self._call_each(interp, args, size)
+        else:
+            arrays = [ arg.data if isinstance(arg, LoxArray) else arg for arg in args ]
+            with loxarray.numpy.errstate(all='ignore'):
+                result.data = _KernelRun(interp, self.func, arrays, size).result
+        return result
+
+    def _call_each(self, interp, args, size):
+        results = array.array('d')
+        for n in range(size):
+            value = self.func.invoke(interp, [ arg.get(float(n)) if isinstance(arg, LoxArray) else arg
+                                               for arg in args ])
+            results.append(float(value))
+        return results
+
+@native(arity=1)
+def vectorize(func):
+    if not isinstance(func, LoxFunction):
+        raise LoxNativeError('vectorize() argument must be a function')
+    try:
+        _KernelChecker(func).check(func.node)
+    except KernelError as err:
+        raise LoxNativeError(f"{func.node.name}() can't be vectorized: {err}")
+    return LoxVectorFunction(func)
+
+def test_vectorize():
+    import io
+    import loxcontext
+    loxarray._load_numpy()
+    saved = loxarray.numpy
+    source = '''
+fun in_mandelbrot(x0, y0, n) {
+    var x = 0.0;
+    var y = 0.0;
+    var xtemp;
+    while (n > 0) {
+        xtemp = x*x - y*y + x0;
+        y = 2.0*x*y + y0;
+        x = xtemp;
+        n = n - 1;
+        if (x*x + y*y > 4.0) {
+            return false;
+        }
+    }
+    return true;
+}
+var in_set = vectorize(in_mandelbrot);
+var xs = Array(9);
+for (var i = 0; i < 9; i = i + 1) xs.set(i, -2 + i * 0.375);
+var row = in_set(xs, 0.25, 100);
+var expected = "";
+var line = "";
+for (var i = 0; i < 9; i = i + 1) {
+    if (in_mandelbrot(xs.get(i), 0.25, 100)) expected = expected + "*"; else expected = expected + ".";
+    if (row.get(i) == 1) line = line + "*"; else line = line + ".";
+}
+print line;
+print line == expected;
+print in_set(0.0, 0.0, 10);
+'''
+    try:
+        for numpy in (saved, None):
+            loxarray.numpy = numpy
+            out = io.BytesIO()
+            context = loxcontext.LoxContext(output=out)
+            context.parse(source)
+            context.run()
+            assert out.getvalue() == b'....***..\nTrue\nTrue\n'
+    finally:
+        loxarray.numpy = saved
+
+    for source, message in [('fun f(x) { print x; return x; }', 'Print statements are not allowed'),
+                            ('fun f(x) { var y; if (x > 0) y = 1; return y; }',
+                             "'y' might be used before it is assigned"),
+                            ('var g = 1; fun f(x) { return x + g; }', "'g' is not a local variable"),
+                            ('fun f(x) { if (x > 0) return true; return x; }',
+                             'it returns both numbers and booleans')]:
+        assert loxcontext._diagnose(source + ' vectorize(f);') == [(1, f"f() can't be vectorized: {message}")]